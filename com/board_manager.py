@@ -0,0 +1,125 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from .pycboard import Pycboard
+
+# ----------------------------------------------------------------------------------------
+#  Board_manager class.
+# ----------------------------------------------------------------------------------------
+
+class Board_manager():
+    '''Run operations on multiple pyboards concurrently using asyncio.  The Pycboard
+    serial protocol is blocking, so each operation on a board runs in a worker thread.
+    Operations are not timed out by default as their duration depends on the work done,
+    e.g. uploading the framework.  If a timeout is specified, a board whose operation
+    does not complete in time is closed and removed from boards, and its worker thread
+    is awaited, so no operation is still using the board when the coroutine returns.
+    Coroutine methods return a list with the result of the operation on each board, or
+    the exception raised if the operation failed or timed out, so one board failing 
+    does not stop the operation on the others.  Scripts and the GUI run coroutines to
+    completion with run(), e.g.:
+
+    manager = Board_manager()
+    manager.run(manager.connect(['COM3', 'COM4']))
+    manager.run(manager.setup_state_machine('blinker'))
+    manager.run(manager.start_framework())
+    '''
+
+    def __init__(self, boards=[], timeout=None, max_workers=32):
+        self.boards = list(boards) # Pycboard instances operations are run on.
+        self.timeout = timeout # Default timeout for operations on each board (seconds), None for no timeout.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run(self, coroutine):
+        '''Run coroutine to completion and return its result.'''
+        return asyncio.run(coroutine)
+
+    async def map(self, func, items, timeout=None, on_timeout=None):
+        '''Call func(item) for each item concurrently in worker threads, return list
+        of results with the exception in place of the result for calls which raised
+        an exception or did not complete within timeout seconds.  When a call times 
+        out on_timeout(item) is called, which should make the call return, e.g. by 
+        closing the board's serial connection, and the call is awaited before map
+        returns.'''
+        loop = asyncio.get_running_loop()
+        if timeout is None:
+            timeout = self.timeout
+        async def call(item):
+            future = loop.run_in_executor(self.executor, func, item)
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                if on_timeout:
+                    on_timeout(item)
+                await asyncio.gather(future, return_exceptions=True) # Wait for worker thread to finish.
+                raise
+        return await asyncio.gather(*[call(item) for item in items], return_exceptions=True)
+
+    async def call(self, method_name, *args, boards=None, timeout=None, **kwargs):
+        '''Call Pycboard method method_name with the specified arguments on each board 
+        concurrently, return list of results.'''
+        if boards is None:
+            boards = self.boards
+        return await self.map(lambda board: getattr(board, method_name)(*args, **kwargs),
+                              boards, timeout, self._discard)
+
+    def _discard(self, board):
+        '''Close the serial connection to a board whose operation timed out, which makes
+        the operation raise an exception, and remove the board from boards.'''
+        try:
+            board.close()
+        except Exception:
+            pass
+        if board in self.boards:
+            self.boards.remove(board)
+
+    # Board operations.
+
+    async def connect(self, serial_ports, timeout=None, **kwargs):
+        '''Connect to boards on the specified serial ports, boards which connect OK are
+        added to boards.  Returns list of Pycboard instances or exceptions.'''
+        timed_out = set() # Serial ports where connecting timed out.
+        def connect(serial_port):
+            board = Pycboard(serial_port, **kwargs)
+            if serial_port in timed_out: # Discard board connected after timeout.
+                board.close()
+            return board
+        results = await self.map(connect, serial_ports, timeout, timed_out.add)
+        self.boards += [board for board in results if isinstance(board, Pycboard)]
+        return results
+
+    async def load_framework(self, boards=None, timeout=None):
+        '''Upload the pyControl framework to boards.'''
+        return await self.call('load_framework', boards=boards, timeout=timeout)
+
+    async def setup_state_machine(self, sm_name, boards=None, timeout=None, **kwargs):
+        '''Upload task sm_name and setup state machine on boards.'''
+        return await self.call('setup_state_machine', sm_name, boards=boards, timeout=timeout, **kwargs)
+
+    async def start_framework(self, boards=None, timeout=None, **kwargs):
+        '''Start framework running on boards.'''
+        return await self.call('start_framework', boards=boards, timeout=timeout, **kwargs)
+
+    async def stop_framework(self, boards=None, timeout=None, process_data=True):
+        '''Stop framework running on boards. If process_data is True, data sent by the 
+        boards after the stop command is processed once all boards have stopped.'''
+        results = await self.call('stop_framework', boards=boards, timeout=timeout)
+        if process_data:
+            await asyncio.sleep(0.05)
+            await self.call('process_data', boards=boards, timeout=timeout)
+        return results
+
+    async def get_variables(self, v_names=None, boards=None, timeout=None):
+        '''Get the values of variables from boards while the framework is not running,
+        returns a dict {v_name: value} for each board, all variables if v_names is None.'''
+        if v_names is None:
+            return await self.call('get_variables', boards=boards, timeout=timeout)
+        return await self.map(lambda board: {v_name: board.get_variable(v_name) for v_name in v_names},
+                              self.boards if boards is None else boards, timeout, self._discard)
+
+    async def close(self, boards=None, timeout=None):
+        '''Close serial connections to boards and remove them from boards.'''
+        if boards is None:
+            boards = self.boards
+        results = await self.call('close', boards=boards, timeout=timeout)
+        self.boards = [board for board in self.boards if board not in boards]
+        return results
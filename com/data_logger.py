@@ -1,5 +1,6 @@
 import os
 import json
+from array import array
 from datetime import datetime
 from shutil import copyfile
 from tools.data_cleaner import Log_cleaner
@@ -73,6 +74,11 @@ class Data_logger():
         human readable data strings are passed to it.'''
         if self.data_file:
             self.write_to_file(new_data)
+        self.display_data(new_data)
+
+    def display_data(self, new_data):
+        '''Pass human readable data strings to print_func and new data to data_consumers
+        if specified.'''
         if self.print_func:
             self.print_func(self.data_to_string(new_data, verbose=True), end='')
         if self.data_consumers:
@@ -94,10 +100,17 @@ class Data_logger():
         data_string = ''
         for nd in new_data:
             if nd[0] == 'D':  # State entry or event.
+                    # Timestamps with microsecond resolution are floats, written with 3 decimal places.
+                    timestamp = '{:.3f}'.format(nd[1]) if isinstance(nd[1], float) else nd[1]
                     if verbose: # Print state or event name.
-                        data_string += 'D {} {}\n'.format(nd[1], self.ID2name_fw[nd[2]])
+                        data_string += 'D {} {}\n'.format(timestamp, self.ID2name_fw[nd[2]])
                     else:       # Print state or event ID.
-                        data_string += 'D {} {}\n'.format(nd[1], nd[2])
+                        data_string += 'D {} {}\n'.format(timestamp, nd[2])
+            elif nd[0] == 'F': # Camera frame checkpoint.
+                if verbose:
+                    data_string += 'F {} {} {}\n'.format(nd[1], self.ID2name_fw[nd[2]], nd[3])
+                else:
+                    data_string += 'F {} {} {}\n'.format(*nd[1:])
             elif nd[0] in ('P', 'V'): # User print output or set variable.
                 data_string += '{} {} {}\n'.format(*nd)
             elif nd[0] == '!': # Error
@@ -115,8 +128,8 @@ class Data_logger():
                             self.ID2name_hw[ID] + '.pca'
             self.analog_files[ID] = open(file_name, 'wb')
         ms_per_sample = 1000 / sampling_rate
-        for i, x in enumerate(data_array):
-            t = int(timestamp + i*ms_per_sample)
-            self.analog_files[ID].write(t.to_bytes(4,'little', signed=True))
-            self.analog_files[ID].write(x.to_bytes(4,'little', signed=True))
+        chunk = array('i', [0] * (2*len(data_array))) # Interleaved timestamps and values.
+        chunk[0::2] = array('i', [int(timestamp + i*ms_per_sample) for i in range(len(data_array))])
+        chunk[1::2] = array('i', data_array)
+        self.analog_files[ID].write(chunk.tobytes())
         self.analog_files[ID].flush()
\ No newline at end of file
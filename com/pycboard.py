@@ -1,6 +1,10 @@
 import os
 import sys
 import time
+import queue
+import struct
+import binascii
+import threading
 import inspect
 from serial import SerialException
 from array import array
@@ -22,32 +26,130 @@ def _djb2_file(file_path):
             h = ((h << 5) + h + int.from_bytes(c,'little')) & 0xFFFFFFFF           
     return h
 
+# Used on pyboard to get hashes of files, -1 for files which do not exist.
+def _file_hashes(file_paths):
+    hashes = []
+    for file_path in file_paths:
+        try:
+            hashes.append(_djb2_file(file_path))
+        except OSError:
+            hashes.append(-1)
+    return hashes
+
 # Used on pyboard to measure free space on filesystem.
 def _fs_free_space(drive='/flash'):
     fs_stat = os.statvfs(drive)
     return fs_stat[0] * fs_stat[3]
 
-# Used on pyboard for file transfer.
-def _receive_file(file_path, file_size):
+# Used on pyboard for file transfer.  Each file is sent as chunks of chunk_size
+# bytes (the last chunk of a file may be shorter) each followed by its 4 byte crc32.
+# 'OK' is sent after every ack_every chunks and after the last chunk of each file.
+# If a chunk is corrupted or not received within timeout ms 'ER' is sent, or 'NS' if
+# the file could not be written due to lack of space, and the transfer is ended.
+def _receive_files(files, chunk_size, ack_every, timeout=1000):
+    import binascii
     usb = pyb.USB_VCP()
     usb.setinterrupt(-1)
-    buf_size = 512
-    buf = bytearray(buf_size)
+    buf = bytearray(chunk_size + 4)
     buf_mv = memoryview(buf)
-    bytes_remaining = file_size
-    try:
-        with open(file_path, 'wb') as f:
-            while bytes_remaining > 0:
-                bytes_read = usb.recv(buf, timeout=5)
-                usb.write(b'OK')
-                if bytes_read:
-                    bytes_remaining -= bytes_read
-                    f.write(buf_mv[:bytes_read])
-    except:
-        if _fs_free_space() < bytes_remaining:
-            usb.write(b'NS') # Out of space.
-        else:
-            usb.write(b'ER')
+    for file_path, file_size in files:
+        bytes_remaining = file_size
+        n_chunks = 0
+        ack = b'OK'
+        try:
+            with open(file_path, 'wb') as f:
+                while bytes_remaining > 0:
+                    chunk_len = min(chunk_size, bytes_remaining)
+                    bytes_read = 0
+                    while bytes_read < chunk_len + 4:
+                        n = usb.recv(buf_mv[bytes_read:chunk_len+4], timeout=timeout)
+                        if not n: # Timeout.
+                            break
+                        bytes_read += n
+                    if (bytes_read < chunk_len + 4 or binascii.crc32(buf_mv[:chunk_len]) !=
+                            int.from_bytes(buf[chunk_len:chunk_len+4], 'little')):
+                        ack = b'ER' # Chunk not received or corrupted.
+                        break
+                    f.write(buf_mv[:chunk_len])
+                    bytes_remaining -= chunk_len
+                    n_chunks += 1
+                    if n_chunks % ack_every == 0 or bytes_remaining == 0:
+                        usb.write(b'OK')
+        except OSError: # File could not be written.
+            ack = b'NS' if _fs_free_space() < bytes_remaining else b'ER'
+        if ack != b'OK':
+            usb.write(ack)
+            while usb.recv(buf, timeout=timeout): # Discard chunks already sent by computer.
+                pass
+            return
+
+# Used on computer to decode batched event and compressed analog frames.
+def _decode_varints(data_bytes):
+    '''Return list of signed integers decoded from zigzag encoded varints.'''
+    values = []
+    x = shift = 0
+    for b in data_bytes:
+        x |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80: # Last byte of varint.
+            values.append((x >> 1) ^ -(x & 1))
+            x = shift = 0
+    return values
+
+def _decode_batch(timestamp, data_bytes):
+    '''Decode data of 'E' frame containing zigzag encoded varint pairs of time since
+    previous event and event ID, return list of ('D', timestamp, ID) tuples.'''
+    values = _decode_varints(data_bytes)
+    events = []
+    for dt, ID in zip(values[::2], values[1::2]):
+        timestamp += dt
+        events.append(('D', timestamp, ID))
+    return events
+
+def _decode_deltas(typecode, data_bytes):
+    '''Decode data of 'Z' frame containing zigzag encoded varint differences between
+    successive samples, return array of samples with specified typecode.'''
+    data_array = array(typecode)
+    x = 0
+    for dx in _decode_varints(data_bytes):
+        x += dx
+        data_array.append(x)
+    return data_array
+
+# Used on computer for file transfer.
+transfer_chunk_size = 2048 # Bytes of file data per chunk.
+transfer_window = 8 # Maximum number of chunks sent before waiting for acknowledgement.
+transfer_ack_every = 4 # Number of chunks acknowledged by each acknowledgement from board.
+transfer_error_message = ('\n\nError: Unable to transfer file. See the troubleshooting docs:\n'
+                          'https://pycontrol.readthedocs.io/en/latest/user-guide/troubleshooting/')
+
+# Used on computer to cache hashes of local files.
+_hash_cache = {} # {file_path: ((modification time ns, size), djb2 hash)}
+
+def _cached_file_hash(file_path):
+    '''Return djb2 hash of file, only recomputed if the file's modification time or
+    size has changed since its hash was last computed.  Used for the framework files
+    compared against the sync manifest, other files are hashed directly.'''
+    stat = os.stat(file_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    if _hash_cache.get(file_path, (None,))[0] != key:
+        _hash_cache[file_path] = (key, _djb2_file(file_path))
+    return _hash_cache[file_path][1]
+
+manifest_path = 'sync_manifest.txt' # File on pyboard storing {target_path: hash} of synced files.
+
+# Used on computer to decode frame headers.
+_A_header = struct.Struct('<cHHHIH') # typecode, ID, sampling rate, data length, timestamp, checksum.
+_D_header = struct.Struct('<IHH')    # timestamp, ID, checksum.
+_U_header = struct.Struct('<IHIH')   # timestamp, ID, microsecond timestamp or frame number, checksum.
+_E_header = struct.Struct('<HIH')    # data length, timestamp, checksum.
+
+# Used on computer to extend microsecond timestamps.
+def _extend_micros(timestamp, timestamp_us):
+    '''Return time in ms with microsecond resolution given a millisecond timestamp
+    and microsecond timestamp modulo 2**30 captured at the same time.'''
+    n_rollovers = round((1000*timestamp - timestamp_us) / 2**30)
+    return (timestamp_us + n_rollovers * 2**30) / 1000
 
 # ----------------------------------------------------------------------------------------
 #  Pycboard class.
@@ -58,7 +160,8 @@ class Pycboard(Pyboard):
     and pyControl operations.
     '''
 
-    def __init__(self, serial_port,  baudrate=115200, verbose=True, print_func=print, data_logger=None):
+    def __init__(self, serial_port,  baudrate=115200, verbose=True, print_func=print, data_logger=None,
+                 sync=True):
         self.serial_port = serial_port
         self.print = print_func        # Function used for print statements.
         self.data_logger = data_logger # Instance of Data_logger class for saving and printing data.
@@ -71,6 +174,11 @@ class Pycboard(Pyboard):
             v_tuple = eval(self.eval(
             "sys.implementation.version if hasattr(sys, 'implementation') else (0,0,0)").decode())
             self.micropython_version = float('{}.{}{}'.format(*v_tuple))
+            if sync: # Transfer framework files which differ from those on board.
+                try:
+                    self.sync_framework()
+                except PyboardError:
+                    self.print('\nUnable to sync pyControl framework to pyboard.')
         except SerialException as e:
             raise(e)
             self.status['serial'] = False
@@ -93,10 +201,15 @@ class Pycboard(Pyboard):
         '''Enter raw repl (soft reboots pyboard), import modules.'''
         self.enter_raw_repl() # Soft resets pyboard.
         self.exec(inspect.getsource(_djb2_file))     # define djb2 hashing function.
-        self.exec(inspect.getsource(_receive_file))  # define recieve file function.
+        self.exec(inspect.getsource(_receive_files)) # define recieve files function.
+        self.exec(inspect.getsource(_file_hashes))   # define file hashes function.
         self.exec(inspect.getsource(_fs_free_space)) # define file system free space function.
         self.exec('import os; import gc; import sys; import pyb')
         self.framework_running = False
+        self.reader = None # Reader thread, if used for current framework run.
+        self.profile_data = {} # Most recent profiler report from board.
+        self.gc_data = {} # Most recent garbage collection telemetry from board.
+        self.read_buffer = bytearray() # Data read from serial line not yet decoded.
         error_message = None
         self.status['usb_mode'] = self.eval('pyb.usb_mode()').decode()
         try:
@@ -181,36 +294,81 @@ class Pycboard(Pyboard):
         '''Copy file at file_path to location target_path on pyboard.'''
         if not target_path:
             target_path = os.path.split(file_path)[-1]
-        file_size = os.path.getsize(file_path)
-        file_hash = _djb2_file(file_path)
-        error_message = '\n\nError: Unable to transfer file. See the troubleshooting docs:\n' \
-                        'https://pycontrol.readthedocs.io/en/latest/user-guide/troubleshooting/'
-        # Try to load file, return once file hash on board matches that on computer.
+        self.transfer_files([(file_path, target_path)])
+
+    def transfer_files(self, files, show_progress=False):
+        '''Copy files to pyboard, files is a list of (file_path, target_path) tuples.
+        Files whose hash on the board matches that on the computer are skipped, the
+        other files are sent in a single raw REPL session by send_files, then files
+        whose hash does not match, including any not sent due to a transfer error, 
+        are sent again, up to 10 attempts.'''
+        file_hashes = {file_path: _djb2_file(file_path) for file_path, target_path in files}
+        # Try to load files, return once file hashes on board match those on computer.
         for i in range(10):
-            if file_hash == self.get_file_hash(target_path):
+            board_hashes = eval(self.eval('_file_hashes({})'.format(
+                repr([target_path for file_path, target_path in files]))).decode())
+            files = [(file_path, target_path) for (file_path, target_path), board_hash 
+                     in zip(files, board_hashes) if file_hashes[file_path] != board_hash]
+            if not files:
                 return
-            self.exec_raw_no_follow("_receive_file('{}',{})"
-                                    .format(target_path, file_size))
-            with open(file_path, 'rb') as f:
-                while True:
-                    chunk = f.read(512)
-                    if not chunk:
-                        break
-                    self.serial.write(chunk)
-                    response_bytes = self.serial.read(2)
-                    if response_bytes != b'OK':
-                        if response_bytes == b'NS':
-                            self.print('\n\nInsufficient space on pyboard filesystem to transfer file.')
-                        else:
-                            self.print(error_message)
-                        time.sleep(0.01)
-                        self.serial.reset_input_buffer()
-                        raise PyboardError
-                self.follow(3)
-        # Unable to transfer file.
-        self.print(error_message)
+            self.send_files(files, show_progress=show_progress)
+        # Unable to transfer files.
+        self.print(transfer_error_message)
         raise PyboardError
 
+    def send_files(self, files, chunk_size=None, window=None, ack_every=None, show_progress=False):
+        '''Send files to pyboard in a single raw REPL session, files is a list of 
+        (file_path, target_path) tuples.  Each file is sent as chunks with a crc32 
+        appended, up to window chunks are sent before waiting for the board to 
+        acknowledge, and the board acknowledges every ack_every chunks. Chunk_size, 
+        window and ack_every default to the transfer_ settings at the top of this file.
+        Returns True if all files were sent, False if the board reported a corrupted 
+        or missing chunk, in which case the transfer is ended and the remaining files
+        are not sent.  Raises PyboardError if the board is out of space.'''
+        chunk_size = chunk_size or transfer_chunk_size
+        window = window or transfer_window
+        ack_every = ack_every or transfer_ack_every
+        window = max(window, ack_every)
+        file_sizes = [os.path.getsize(file_path) for file_path, target_path in files]
+        self.exec_raw_no_follow('_receive_files({}, {}, {})'.format(repr([(target_path, file_size)
+            for (file_path, target_path), file_size in zip(files, file_sizes)]), chunk_size, ack_every))
+        for (file_path, target_path), file_size in zip(files, file_sizes):
+            n_chunks = -(-file_size // chunk_size) # Number of chunks in file.
+            n_acks = -(-n_chunks // ack_every) # Number of acknowledgements board will send.
+            chunks_sent = 0
+            acks_received = 0
+            with open(file_path, 'rb') as f:
+                while chunks_sent < n_chunks:
+                    chunk = f.read(chunk_size)
+                    self.serial.write(chunk + binascii.crc32(chunk).to_bytes(4, 'little'))
+                    chunks_sent += 1
+                    if chunks_sent - acks_received*ack_every >= window:
+                        if not self._check_transfer_ack():
+                            return False
+                        acks_received += 1
+            while acks_received < n_acks:
+                if not self._check_transfer_ack():
+                    return False
+                acks_received += 1
+            if show_progress:
+                self.print('.', end='')
+                sys.stdout.flush()
+        self.follow(3)
+        return True
+
+    def _check_transfer_ack(self):
+        '''Read acknowledgement from board during file transfer, return True if 'OK'.
+        If the transfer failed, wait for the board to end the transfer, then return
+        False if a chunk was corrupted or raise PyboardError if out of space.'''
+        response_bytes = self.serial.read(2)
+        if response_bytes == b'OK':
+            return True
+        self.follow(10) # Board discards chunks in flight then _receive_files returns.
+        if response_bytes == b'NS':
+            self.print('\n\nInsufficient space on pyboard filesystem to transfer file.')
+            raise PyboardError
+        return False
+
 
     def transfer_folder(self, folder_path, target_folder=None, file_type='all',
                         show_progress=False):
@@ -232,13 +390,8 @@ class Pycboard(Pyboard):
             for f in remove_files:
                 target_path = target_folder + '/' + f
                 self.remove_file(target_path)
-        for f in files:
-            file_path = os.path.join(folder_path, f)
-            target_path = target_folder + '/' + f
-            self.transfer_file(file_path, target_path)
-            if show_progress:
-                self.print('.', end='')
-                sys.stdout.flush()
+        self.transfer_files([(os.path.join(folder_path, f), target_folder + '/' + f) for f in files],
+                            show_progress=show_progress)
 
     def remove_file(self, file_path):
         '''Remove a file from the pyboard.'''
@@ -253,6 +406,8 @@ class Pycboard(Pyboard):
         self.print('\nTransfering pyControl framework to pyboard.', end='')
         self.transfer_folder(dirs['framework'], file_type='py', show_progress=True)
         self.transfer_folder(dirs['devices']  , file_type='py', show_progress=True)
+        self.write_manifest({target_path: _cached_file_hash(file_path) 
+                             for file_path, target_path in self.framework_files()})
         error_message = self.reset()
         if not self.status['framework']:
             self.print('\nError importing framework:')
@@ -261,6 +416,61 @@ class Pycboard(Pyboard):
             self.print(' OK')
         return 
 
+    def sync_framework(self):
+        '''Transfer the framework and devices files which differ from those recorded in
+        the manifest on the board, remove files no longer on the computer and update
+        the manifest. If the board is up to date this requires only reading the 
+        manifest. Files changed on the board other than by pyControl are not detected, 
+        use load_framework to check every file.'''
+        files = self.framework_files()
+        local_hashes = {target_path: _cached_file_hash(file_path) for file_path, target_path in files}
+        manifest = self.get_manifest()
+        changed_files = [(file_path, target_path) for file_path, target_path in files
+                         if manifest.get(target_path) != local_hashes[target_path]]
+        removed_files = [target_path for target_path in manifest if target_path not in local_hashes]
+        if not (changed_files or removed_files):
+            return
+        self.print('\nSyncing pyControl framework to pyboard.', end='')
+        for folder_path in (dirs['framework'], dirs['devices']):
+            try:
+                self.exec('os.mkdir({})'.format(repr(os.path.split(folder_path)[-1])))
+            except PyboardError:
+                pass # Folder already exists.
+        for target_path in removed_files:
+            try:
+                self.remove_file(target_path)
+            except PyboardError:
+                pass # File already removed.
+        self.transfer_files(changed_files, show_progress=True)
+        self.write_manifest(local_hashes)
+        error_message = self.reset()
+        if not self.status['framework']:
+            self.print('\nError importing framework:')
+            self.print(error_message)
+        else:
+            self.print(' OK')
+
+    def framework_files(self):
+        '''Return list of (file_path, target_path) of the framework and devices files.'''
+        files = []
+        for folder_path in (dirs['framework'], dirs['devices']):
+            target_folder = os.path.split(folder_path)[-1]
+            files += [(os.path.join(folder_path, f), target_folder + '/' + f) 
+                      for f in os.listdir(folder_path) if f.split('.')[-1] == 'py']
+        return files
+
+    def get_manifest(self):
+        '''Return manifest {target_path: hash} of synced files from the board, empty
+        dict if board has no manifest.'''
+        try:
+            return eval(self.eval('open({}).read()'.format(repr(manifest_path))).decode())
+        except (PyboardError, SyntaxError):
+            return {}
+
+    def write_manifest(self, manifest):
+        '''Write manifest {target_path: hash} of synced files to the board.'''
+        self.write_file(manifest_path, repr(manifest))
+
     def load_hardware_definition(self, hwd_path=os.path.join(dirs['config'], 'hardware_definition.py')):
         '''Transfer a hardware definition file to pyboard.  Defaults to transfering 
         file hardware_definition.py from config folder.'''
@@ -330,76 +540,220 @@ class Pycboard(Pyboard):
         '''Return analog_inputs as a directory {input name: ID}'''
         return eval(self.exec('hw.get_analog_inputs()').decode().strip())
 
-    def start_framework(self, dur=None, data_output=True):
-        '''Start pyControl framwork running on pyboard.'''
+    def start_framework(self, dur=None, data_output=True, batch_output=False, us_timestamps=False,
+                        profile=False, profile_interval=0, gc_threshold=0, reader_thread=False):
+        '''Start pyControl framwork running on pyboard.  If batch_output is True
+        consecutive events and state changes are sent in a single frame. If 
+        us_timestamps is True events generated by interrupts have microsecond
+        resolution timestamps. If profile is True the board records run loop 
+        statistics, which are sent every profile_interval ms (if non-zero), when 
+        requested with request_profile and at the end of the run. If gc_threshold 
+        is non-zero the board collects garbage in idle time when free memory falls
+        below gc_threshold bytes, and sends garbage collection telemetry after each
+        collection and at the end of the run. If reader_thread is True data from the 
+        board is decoded and written to the data file by a background thread, and 
+        process_data passes the data decoded since it was last called to data_logger
+        for printing and plotting, so data capture is not delayed by the caller.'''
         self.gc_collect()
         self.exec('fw.data_output = ' + repr(data_output))
+        self.exec('fw.batch_output = ' + repr(batch_output))
+        self.exec('fw.us_timestamps = ' + repr(us_timestamps))
+        self.exec('fw.profile = {}; fw.profile_interval = {}'.format(repr(profile), int(profile_interval)))
+        self.exec('fw.gc_threshold = {}'.format(int(gc_threshold)))
         self.serial.reset_input_buffer()
+        self.read_buffer = bytearray()
         self.exec_raw_no_follow('fw.run({})'.format(dur))
         self.framework_running = True
+        if reader_thread:
+            self.data_queue = queue.Queue() # Data decoded by reader thread.
+            self.stop_reader = threading.Event() # Set to stop reader thread before end of run received.
+            self.reader = threading.Thread(target=self._read_data, daemon=True)
+            self.reader.start()
+
+    def request_profile(self):
+        '''Request profiler report from board while framework is running. The report 
+        is stored as a dict in profile_data once it is received by process_data.'''
+        if self.framework_running:
+            self.serial.write(b'R')
 
     def stop_framework(self):
-        '''Stop framework running on pyboard by sending stop command.'''
+        '''Stop framework running on pyboard by sending stop command.  If a reader 
+        thread is running, wait for it to receive the end of the run, or if this is 
+        not received within 5 seconds stop the thread, so no data is written to the 
+        data file after stop_framework returns.'''
         self.serial.write(b'\x03') # Stop signal
         self.framework_running = False
+        if self.reader: # Wait for reader thread to receive end of run.
+            self.reader.join(timeout=5)
+            if self.reader.is_alive(): # End of run not received.
+                self.stop_reader.set()
+                self.reader.join()
 
     def process_data(self):
-        '''Read data from serial line, generate list new_data of data tuples, 
-        pass new_data to data_logger and print_func if specified, return new_data.'''
-        new_data = []
-        error_message = None
-        while self.serial.inWaiting() > 0:
-            new_byte = self.serial.read(1)  
-            if new_byte == b'A': # Analog data, 13 byte header + variable size content.
-                data_header = self.serial.read(13)
-                typecode      = data_header[0:1].decode() 
-                if typecode not in ('b','B','h','H','l','L'):
-                    new_data.append(('!','bad typecode A'))
-                    continue   
-                ID            = int.from_bytes(data_header[1:3], 'little')
-                sampling_rate = int.from_bytes(data_header[3:5], 'little')
-                data_len      = int.from_bytes(data_header[5:7], 'little')
-                timestamp     = int.from_bytes(data_header[7:11], 'little')
-                checksum      = int.from_bytes(data_header[11:13], 'little')
-                data_array    = array(typecode, self.serial.read(data_len))
-                if checksum == (sum(data_header[:-2]) + sum(data_array)) & 0xffff: # Checksum OK.
-                    new_data.append(('A',ID, sampling_rate, timestamp, data_array))
-                else:
-                    new_data.append(('!','bad checksum A'))
-            elif new_byte == b'D': # Event or state entry, 8 byte data header only.
-                data_header = self.serial.read(8)
-                timestamp = int.from_bytes(data_header[ :4], 'little')
-                ID        = int.from_bytes(data_header[4:6], 'little')
-                checksum  = int.from_bytes(data_header[6:8], 'little')
-                if checksum == sum(data_header[:-2]): # Checksum OK.
-                    new_data.append(('D',timestamp, ID))
-                else:
-                    new_data.append(('!','bad checksum D'))
-            elif new_byte in (b'P', b'V'): # User print statement or set variable, 8 byte data header + variable size content.
-                data_header = self.serial.read(8)
-                data_len  = int.from_bytes(data_header[ :2], 'little')
-                timestamp = int.from_bytes(data_header[2:6], 'little')
-                checksum  = int.from_bytes(data_header[6:8], 'little')
-                data_bytes = self.serial.read(data_len)
-                if not checksum == (sum(data_header[:-2]) + sum(data_bytes)) & 0xffff: # Bad checksum.
-                    new_data.append(('!','bad checksum ' + new_byte.decode()))
-                    continue
-                new_data.append((new_byte.decode(),timestamp, data_bytes.decode()))
-                if new_byte == b'V': # Store new variable value in sm_info
-                    v_name, v_str = data_bytes.decode().split(' ', 1)
-                    self.sm_info['variables'][v_name] = eval(v_str)
-            elif new_byte == b'\x04': # End of framework run.
-                self.framework_running = False
-                data_err = self.read_until(2, b'\x04>', timeout=10) 
-                if len(data_err) > 2:
-                    error_message = data_err[:-3].decode()
-                    new_data.append(('!', error_message))                
-                break
-        if new_data and self.data_logger:
-            self.data_logger.process_data(new_data)
+        '''Generate list new_data of data tuples from data received from the board and
+        pass new_data to data_logger if specified.  If a reader thread is running, 
+        new_data is the data it has decoded since process_data was last called and has
+        already been written to the data file, otherwise data is read from the serial
+        line and decoded by _decode_data.'''
+        if self.reader:
+            new_data = []
+            run_ended = False
+            error_message = None
+            while not self.data_queue.empty():
+                thread_data, run_ended, error_message = self.data_queue.get()
+                new_data += thread_data
+            if new_data and self.data_logger:
+                self.data_logger.display_data(new_data)
+            if run_ended:
+                self.reader = None
+        else:
+            new_data, run_ended, error_message = self._decode_data()
+            if new_data and self.data_logger:
+                self.data_logger.process_data(new_data)
+        if run_ended:
+            self.framework_running = False
         if error_message:
             raise PyboardError(error_message)
 
+    def _read_data(self):
+        '''Reader thread function, decodes data from serial line, writes it to data file
+        and puts it in data_queue until the end of the framework run or stop_reader 
+        is set.'''
+        run_ended = False
+        while not run_ended:
+            try:
+                new_data, run_ended, error_message = self._decode_data()
+            except SerialException:
+                new_data, run_ended, error_message = ([], True, 'Serial connection lost.')
+            if new_data and self.data_logger and self.data_logger.data_file:
+                self.data_logger.write_to_file(new_data)
+            if self.stop_reader.is_set():
+                run_ended = True
+            if new_data or run_ended:
+                self.data_queue.put((new_data, run_ended, error_message))
+            else:
+                time.sleep(0.001)
+
+    def _decode_data(self):
+        '''Read all available data from serial line into read_buffer and decode complete
+        frames in place, return list new_data of data tuples, whether the framework run
+        ended and the error message if the run ended due to an error.  Bytes of incomplete
+        frames are kept in read_buffer and decoded when the rest of the frame has been 
+        received.'''
+        new_data = []
+        run_ended = False
+        error_message = None
+        n_waiting = self.serial.inWaiting()
+        if n_waiting:
+            self.read_buffer += self.serial.read(n_waiting)
+        buf = self.read_buffer
+        i = 0 # Index of start of next frame in buf.
+        with memoryview(buf) as mv:
+            while i < len(buf):
+                frame_type = buf[i]
+                if frame_type in (65, 90): # 'A' or 'Z', analog data or compressed analog data, 13 byte header + variable size content.
+                    if i + 14 > len(buf):
+                        break # Incomplete header.
+                    typecode, ID, sampling_rate, data_len, timestamp, checksum = _A_header.unpack_from(buf, i+1)
+                    typecode = typecode.decode()
+                    if typecode not in ('b','B','h','H','l','L'):
+                        new_data.append(('!','bad typecode ' + chr(frame_type)))
+                        i += 14
+                        continue
+                    if i + 14 + data_len > len(buf):
+                        break # Incomplete data.
+                    with mv[i+14:i+14+data_len] as data_bytes:
+                        if frame_type == 65: # 'A'
+                            data_array = array(typecode)
+                            data_array.frombytes(data_bytes)
+                            data_sum = sum(data_array)
+                        else: # Compressed chunk, checksum is sum of data bytes.
+                            data_array = _decode_deltas(typecode, data_bytes)
+                            data_sum = sum(data_bytes)
+                    if checksum == (sum(mv[i+1:i+12]) + data_sum) & 0xffff: # Checksum OK.
+                        new_data.append(('A',ID, sampling_rate, timestamp, data_array))
+                    else:
+                        new_data.append(('!','bad checksum ' + chr(frame_type)))
+                    i += 14 + data_len
+                elif frame_type == 68: # 'D', event or state entry, 8 byte data header only.
+                    if i + 9 > len(buf):
+                        break
+                    timestamp, ID, checksum = _D_header.unpack_from(buf, i+1)
+                    if checksum == sum(mv[i+1:i+7]): # Checksum OK.
+                        new_data.append(('D',timestamp, ID))
+                    else:
+                        new_data.append(('!','bad checksum D'))
+                    i += 9
+                elif frame_type == 85: # 'U', event with microsecond timestamp, 12 byte data header only.
+                    if i + 13 > len(buf):
+                        break
+                    timestamp, ID, timestamp_us, checksum = _U_header.unpack_from(buf, i+1)
+                    if checksum == sum(mv[i+1:i+11]): # Checksum OK.
+                        new_data.append(('D', _extend_micros(timestamp, timestamp_us), ID))
+                    else:
+                        new_data.append(('!','bad checksum U'))
+                    i += 13
+                elif frame_type == 70: # 'F', camera frame checkpoint, 12 byte data header only.
+                    if i + 13 > len(buf):
+                        break
+                    timestamp, ID, frame_number, checksum = _U_header.unpack_from(buf, i+1)
+                    if checksum == sum(mv[i+1:i+11]): # Checksum OK.
+                        new_data.append(('F', timestamp, ID, frame_number))
+                    else:
+                        new_data.append(('!','bad checksum F'))
+                    i += 13
+                elif frame_type in (69, 80, 86, 82, 71): # 'E' batch of events and state entries, 'P' user print statement, 'V' set variable,
+                                                         # 'R' profiler report or 'G' garbage collection telemetry, 8 byte data header + variable size content.
+                    if i + 9 > len(buf):
+                        break
+                    data_len, timestamp, checksum = _E_header.unpack_from(buf, i+1)
+                    if i + 9 + data_len > len(buf):
+                        break
+                    with mv[i+9:i+9+data_len] as data_bytes:
+                        checksum_OK = checksum == (sum(mv[i+1:i+7]) + sum(data_bytes)) & 0xffff
+                        if checksum_OK and frame_type == 69: # 'E'
+                            new_data += _decode_batch(timestamp, data_bytes)
+                        elif checksum_OK:
+                            data_string = str(data_bytes, 'utf-8')
+                    i += 9 + data_len
+                    if not checksum_OK:
+                        new_data.append(('!','bad checksum ' + chr(frame_type)))
+                        continue
+                    if frame_type == 69:
+                        continue
+                    if frame_type == 82: # 'R', store profiler report in profile_data.
+                        self.profile_data = eval(data_string)
+                        self.profile_data['timestamp'] = timestamp
+                        continue
+                    if frame_type == 71: # 'G', store garbage collection telemetry in gc_data.
+                        self.gc_data = eval(data_string)
+                        self.gc_data['timestamp'] = timestamp
+                        continue
+                    new_data.append((chr(frame_type), timestamp, data_string))
+                    if frame_type == 86: # 'V', store new variable value in sm_info
+                        v_name, v_str = data_string.split(' ', 1)
+                        self.sm_info['variables'][v_name] = eval(v_str)
+                elif frame_type == 4: # End of framework run.
+                    run_ended = True
+                    data_err = bytes(mv[i+1:])
+                    i = len(buf)
+                    timeout_count = 0
+                    while not data_err.endswith(b'\x04>') and timeout_count < 100:
+                        if self.serial.inWaiting() > 0:
+                            data_err += self.serial.read(self.serial.inWaiting())
+                            timeout_count = 0
+                        else:
+                            timeout_count += 1
+                            time.sleep(0.1)
+                    if len(data_err) > 2:
+                        error_message = data_err[:-3].decode()
+                        new_data.append(('!', error_message))
+                    break
+                else: # Byte not at start of a known frame type.
+                    i += 1
+        del buf[:i]
+        return new_data, run_ended, error_message
+
     # ------------------------------------------------------------------------------------
     # Getting and setting variables.
     # ------------------------------------------------------------------------------------
@@ -412,7 +766,7 @@ class Pycboard(Pyboard):
             raise PyboardError('Invalid variable name: {}'.format(v_name))
         v_str = repr(v_value)
         if self.framework_running: # Set variable with serial command.
-            data = repr((v_name, v_str)).encode() + b's'
+            data = (v_name + ' ' + v_str).encode() + b's'
             data_len = len(data).to_bytes(2, 'little')
             checksum = sum(data).to_bytes(2, 'little')
             self.serial.write(b'V' + data_len +  data + checksum)
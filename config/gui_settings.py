@@ -2,6 +2,7 @@
 
 VERSION = '1.6 : 2021-01-19'
 update_interval = 20 # Interval between calls to the GUIs update function (ms).
+reader_thread = False # Whether data from the board is read and saved by a background thread during runs.
 
 event_history_len  = 250  # Length of event history to plot (# events).
 state_history_len  = 75  # Length of state history to plot (# states).
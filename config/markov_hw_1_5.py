@@ -16,9 +16,9 @@ Rpoke       = Nosepoke(board.port_5, nose_event = 'R_nose', lick_event = 'R_lick
 houselight  = _h.Digital_output(board.port_6.POW_A)
 
 ######### Bottom Row ###########
-Camera      = Camera(board.port_7, sync_event = 'Sync_pulse')
+Camera      = Camera(board.port_7, sync_event = 'Sync_pulse', frame_event = 'Frame_checkpoint')
 Speakers    = Teensy_audio(board.port_8)
 # empty port 9
-BaseStation = Base_station_serial(board.port_10) 
-Rpump       = Syringe_pump(board.port_11)
-Lpump       = Syringe_pump(board.port_12)
\ No newline at end of file
+BaseStation = Base_station_serial(board.port_10, message_event = 'base_station_message')
+Rpump       = Syringe_pump(board.port_11, message_event = 'R_pump_message')
+Lpump       = Syringe_pump(board.port_12, message_event = 'L_pump_message')
\ No newline at end of file
@@ -1,5 +1,5 @@
 import os
-from pyControl.hardware import Digital_input, Digital_output, Analog_input, Rsync, off
+from pyControl.hardware import Digital_input, Digital_output, Analog_input, Analog_sampler, Pulse_counter, Rsync, off
 
 _driver_files = [f.split('.')[0] for f in os.listdir('devices') if 'init' not in f]
 
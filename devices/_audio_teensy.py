@@ -1,26 +1,30 @@
+import pyControl.hardware as _h
 from machine import UART
 from array import array
 
-class Teensy_audio():
-    def __init__(self, port):
+class Teensy_audio(_h.UART_line_device):
+    # If message_event is specified an event is published for each message received
+    # from the Teensy.
+    def __init__(self, port, message_event=None):
         assert port.UART is not None, '! Teensy Audio Player needs a port with UART.'
-        self.uart = UART(port.UART, 9600)
-        self.uart.init(9600, bits=8, parity=None, stop=1, timeout=1)
-        self.uart.write('S')
+        uart = UART(port.UART, 9600)
+        uart.init(9600, bits=8, parity=None, stop=1, timeout=1)
+        super().__init__(uart, message_event)
+        self.write('S')
 
     def play(self, side):
         if side == 'Left':
-            self.uart.write('L')
+            self.write('L')
         elif side == 'Right':
-            self.uart.write('R')
+            self.write('R')
         return True
 
     def beep(self):
-        self.uart.write('B')
+        self.write('B')
 
     def stop(self):
-        self.uart.write('S')
+        self.write('S')
         return False
 
     def set_volume(self, volume): # Between 1 - 65
-        self.uart.write('V,{}'.format(volume))
\ No newline at end of file
+        self.write('V,{}'.format(volume))
\ No newline at end of file
@@ -1,23 +1,23 @@
 import pyControl.hardware as _h
 from machine import UART
 
-class Base_station_serial():
-    def __init__(self, port):
+class Base_station_serial(_h.UART_line_device):
+    # If message_event is specified an event is published for each message received
+    # from the base station.
+    def __init__(self, port, message_event=None):
         assert port.UART is not None, '! Base Station needs port with UART.'
-        self.uart = UART(port.UART, 57600)
-        self.uart.init(57600, bits=8, parity=None, stop=1, timeout=2, rxbuf = 150)
+        uart = UART(port.UART, 57600)
+        uart.init(57600, bits=8, parity=None, stop=1, timeout=2, rxbuf = 150)
+        super().__init__(uart, message_event)
 
     def trigger(self):
-        self.uart.write('T')
+        self.write('T')
 
     def stop(self):
-        self.uart.write('A')
+        self.write('A')
 
     def check_for_serial(self):
-        if self.uart.any():
-            return self.uart.readline().decode("utf-8").strip('\n')
-        else:
-            return None
+        return self.read_line()
 
     def set_to_zero(self):
-        self.uart.write('K,0\n')
\ No newline at end of file
+        self.write('K,0\n')
\ No newline at end of file
@@ -1,7 +1,121 @@
+import pyb
+import stm
 import pyControl.hardware as _h
+import pyControl.framework as fw
+
+# Timers whose update event can clock each timer through its internal trigger 
+# inputs ITR0-ITR3, from the STM32F4 reference manual.
+_ITR_masters = {2: (1, 8, 3, 4), 3: (1, 2, 5, 4), 4: (1, 2, 3, 8), 5: (2, 3, 4, 8),
+                8: (1, 2, 4, 5), 9: (2, 3), 12: (4, 5)}
+
+class Frame_trigger(_h.Digital_output):
+    # Digital output used to trigger camera frames which counts the trigger pulses and
+    # every checkpoint_interval frames outputs a checkpoint with the frame number and
+    # the time the frame was triggered, from which the times of all frames can be
+    # reconstructed by interpolation (see tools/frame_times.py).  If pulses are
+    # generated by PWM, frames are counted in hardware by a second timer clocked by the
+    # update event of the PWM timer, whose overflow interrupt outputs each checkpoint,
+    # so there is one interrupt per checkpoint rather than per frame.  If the pin does
+    # not support PWM or no timer can be clocked by the PWM timer, frames are counted
+    # in the pulse timer callback.
+
+    def __init__(self, pin, frame_event=None, checkpoint_interval=50):
+        self.frame_event = frame_event
+        self.checkpoint_interval = checkpoint_interval
+        self.counting = False # True while frames are being counted.
+        self.frame_counter = None # Timer counting frames in hardware.
+        super().__init__(pin, pulse_enabled=True)
+        if self.PWM_channel: # Find timer that can be clocked by PWM timer.
+            for timer_n in _h.available_timers:
+                if self.timer_n in _ITR_masters.get(timer_n, ()):
+                    _h.available_timers.remove(timer_n)
+                    self.frame_counter = pyb.Timer(timer_n)
+                    self.counter_base = getattr(stm, 'TIM{}'.format(timer_n))
+                    self.ITR = _ITR_masters[timer_n].index(self.timer_n)
+                    self.timer_base = getattr(stm, 'TIM{}'.format(self.timer_n))
+                    break
+
+    def _initialise(self):
+        self.event_ID = fw.events[self.frame_event] if self.frame_event in fw.events else False
+
+    def _run_start(self):
+        self.frame_number = 0 # Frame numbers count from start of run.
+
+    def pulse(self, freq, duty_cycle=50, n_pulses=False):
+        if self.counting:
+            self.off()
+        super().pulse(freq, duty_cycle, n_pulses)
+        if self.event_ID:
+            self.counting = True
+            self.start_frame = self.frame_number
+            fw.data_output_queue.put(fw.time_now(), fw.frame_typ, (self.event_ID, self.frame_number))
+            if self.frame_counter:
+                self._start_frame_counter()
+            elif self.PWM_channel: # Count frames at the start of each PWM period.
+                self.timer.callback(self._PWM_frame_ISR)
+
+    def off(self):
+        if self.counting:
+            self.counting = False
+            if self.frame_counter:
+                self.frame_number = self.start_frame + self._frames_counted()
+                self.frame_counter.deinit()
+            else:
+                self.frame_number += 1 # Next pulse() starts a new frame.
+        super().off()
+
+    def _start_frame_counter(self):
+        # Start frame counter counting update events of PWM timer, starting from the 
+        # position of the current frame between checkpoints so it overflows when each
+        # checkpoint frame is triggered.
+        self.next_checkpoint = (self.frame_number//self.checkpoint_interval + 1)*self.checkpoint_interval
+        self.frame_counter.init(prescaler=0, period=self.checkpoint_interval-1)
+        stm.mem16[self.timer_base + stm.TIM_CR2] = (stm.mem16[self.timer_base + stm.TIM_CR2] & ~0x70) | 0x20 # PWM timer trigger output on update.
+        stm.mem16[self.counter_base + stm.TIM_SMCR] = (self.ITR << 4) | 7 # Trigger ITRx, external clock mode 1.
+        self.frame_counter.counter(self.frame_number % self.checkpoint_interval)
+        stm.mem16[self.counter_base + stm.TIM_SR] = 0 # Clear update flag set by init.
+        self.frame_counter.callback(self._checkpoint_ISR)
+
+    def _frames_counted(self):
+        # Return number of frames triggered since pulse() was called from frame counter.
+        irq_state = pyb.disable_irq()
+        counter = self.frame_counter.counter()
+        if stm.mem16[self.counter_base + stm.TIM_SR] & 1: # Overflow interrupt pending.
+            counter = self.frame_counter.counter() + self.checkpoint_interval
+        n_frames = self.next_checkpoint - self.checkpoint_interval + counter - self.start_frame + 1
+        pyb.enable_irq(irq_state)
+        return min(n_frames, self.n_pulses) if self.n_pulses else n_frames
+
+    def _checkpoint_ISR(self, t):
+        # Called by frame counter overflow when checkpoint frame is triggered.
+        if not self.n_pulses or self.next_checkpoint - self.start_frame < self.n_pulses:
+            _h.interrupt_queue.put(self.ID, fw.time_now(), fw.time_now_us() if fw.us_timestamps else -1,
+                                   self.next_checkpoint)
+        self.next_checkpoint += self.checkpoint_interval
+
+    def _ISR(self, t):
+        super()._ISR(t)
+        if self.counting and self.i == 0 and self.state: # Pin toggled on, new frame.
+            self._count_frame()
+
+    def _PWM_frame_ISR(self, t):
+        if self.n_pulses:
+            self._PWM_ISR(t)
+        if self.PWM_active:
+            self._count_frame()
+
+    def _count_frame(self):
+        # Called from timer callback at the start of each frame after the first.
+        self.frame_number += 1
+        if self.frame_number % self.checkpoint_interval == 0:
+            _h.interrupt_queue.put(self.ID, fw.time_now(), fw.time_now_us() if fw.us_timestamps else -1,
+                                   self.frame_number)
+
+    def _process_interrupt(self, timestamp, timestamp_us, frame_number):
+        fw.data_output_queue.put(timestamp, fw.frame_typ, (self.event_ID, frame_number))
 
 class Camera():
-    def __init__(self, port, sync_event):
-        self.frame_grab_trigger = _h.Digital_output(port.DIO_A, pulse_enabled=True)
+    def __init__(self, port, sync_event, frame_event=None, checkpoint_interval=50):
+        self.frame_grab_trigger = Frame_trigger(port.DIO_A, frame_event, checkpoint_interval)
         self.sync_pulse = _h.Rsync(port.DIO_B,sync_event, mean_IPI= 5000, pulse_dur= 50 )
         self.light = _h.Digital_output(pin=port.POW_B,pulse_enabled=True)
\ No newline at end of file
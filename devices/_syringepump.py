@@ -1,24 +1,24 @@
 import pyControl.hardware as _h
 from machine import UART
 
-class Syringe_pump():
-    def __init__(self, port):
+class Syringe_pump(_h.UART_line_device):
+    # The pump sends a message when it reaches its limit switch, if message_event is
+    # specified an event is published when the message is received.
+    def __init__(self, port, message_event=None):
         assert port.UART is not None, '! Pump needs port with UART.'
-        self.uart = UART(port.UART, 9600)
-        self.uart.init(9600, bits=8, parity=None, stop=1, timeout=100)
-        self.uart.write('C')
+        uart = UART(port.UART, 9600)
+        uart.init(9600, bits=8, parity=None, stop=1, timeout=100)
+        super().__init__(uart, message_event)
+        self.write('C')
 
     def infuse(self,val):
-        self.uart.write('I,{}\n'.format(val))
+        self.write('I,{}\n'.format(val))
 
     def check_for_serial(self):
-        if self.uart.any():
-            return self.uart.readline().decode("utf-8").strip('\n')
-        else:
-            return None
+        return self.read_line()
     
     def reset_volume(self):
-        self.uart.write('Z')
+        self.write('Z')
     
     def retract(self):
-        self.uart.write('R')
\ No newline at end of file
+        self.write('R')
\ No newline at end of file
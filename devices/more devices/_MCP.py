@@ -1,17 +1,20 @@
 import pyb
-import math
 from array import array
 import pyControl.hardware as _h
 
 class _MCP(_h.IO_object):
-    # Parent class for MCP23017 and MCP23008 port expanders.
+    # Parent class for MCP23017 and MCP23008 port expanders.  When the interrupt pin 
+    # is triggered the INTF, INTCAP and GPIO registers are read in a single I2C burst
+    # read and the callback for every pin with its interrupt flag set is called. If 
+    # use_INTCAP is True the values of flagged pins are taken from INTCAP, which holds 
+    # the pin values captured when the interrupt occured, rather than GPIO.
 
-    def __init__(self, I2C_bus, interrupt_pin, addr):
+    def __init__(self, I2C_bus, interrupt_pin, addr, use_INTCAP=False):
         self.i2c = pyb.I2C(I2C_bus, mode=pyb.I2C.MASTER, baudrate=400000) 
         self.addr = addr   # Device I2C address
-        self.interrupt_timestamp = 0  # Time of last interrupt.
         self.interrupts_enabled = False
         self.interrupt_pin = interrupt_pin
+        self.use_INTCAP = use_INTCAP
         self.reg_values = {} # Register values set by user.
         _h.assign_ID(self)
 
@@ -51,17 +54,30 @@ class _MCP(_h.IO_object):
         self.write_bit('IOCON',6,True, n_bytes=1) # Set port A, B interrupt pins to mirror.
         self.extint = pyb.ExtInt(self.interrupt_pin, pyb.ExtInt.IRQ_RISING, pyb.Pin.PULL_NONE, self.ISR)
         self.pin_callbacks = {} # Dictionary of {pin: callback}
+        self.interrupt_buffer = bytearray(3*self.reg_size) # Buffer for INTF, INTCAP and GPIO.
         self.interrupts_enabled = True
 
     def ISR(self, i):
-        _h.interrupt_queue.put(self.ID)
+        _h.interrupt_queue.put(self.ID, _h.fw.time_now(), -1, 0)
         
-    def _process_interrupt(self):
-        INTF = self.read_register('INTF')
-        self.read_register('GPIO')
-        if INTF > 0:
-            pin = int(math.log2(INTF)+0.1)
-            self.pin_callbacks[pin](pin) # Called with pin as an argument for consistency with pyb.ExtInt
+    def _process_interrupt(self, timestamp, timestamp_us, data):
+        # Read INTF, INTCAP and GPIO registers, which have consecutive addresses, in a 
+        # single burst read and call callback for each pin with interrupt flag set.
+        self.i2c.mem_read(self.interrupt_buffer, self.addr, self.reg_addr['INTF'])
+        n = self.reg_size
+        INTF   = int.from_bytes(self.interrupt_buffer[  :n  ], 'little')
+        INTCAP = int.from_bytes(self.interrupt_buffer[n :2*n], 'little')
+        GPIO   = int.from_bytes(self.interrupt_buffer[2*n:  ], 'little')
+        if self.use_INTCAP: # Use values captured at interrupt for flagged pins.
+            GPIO = (GPIO & ~INTF) | (INTCAP & INTF)
+        self.reg_values['INTF'] = INTF
+        self.reg_values['GPIO'] = GPIO
+        pin = 0
+        while INTF:
+            if INTF & 1 and pin in self.pin_callbacks:
+                self.pin_callbacks[pin](pin) # Called with pin as an argument for consistency with pyb.ExtInt
+            INTF >>= 1
+            pin += 1
 
     def Pin(self, id, mode=None, pull=None):
         # Instantiate and return a Pin object, pull argument currently ignored.
@@ -79,13 +95,14 @@ class MCP23017(_MCP):
     # MCP23017 16 bit port expander. Ports A and B are addressed as single 16 bit port
     # and use a single interrupt pin.
 
-    def __init__(self, I2C_bus=1, interrupt_pin='X5', addr=0x20):
-        super().__init__(I2C_bus, interrupt_pin, addr)
+    def __init__(self, I2C_bus=1, interrupt_pin='X5', addr=0x20, use_INTCAP=False):
+        super().__init__(I2C_bus, interrupt_pin, addr, use_INTCAP)
         self.reg_addr = {                 # Register memory addresses.
                          'IODIR'  : 0x00, # Input / output direction.
                          'GPIO'   : 0x12, # Pin state.
                          'GPINTEN': 0x04, # Interrupt on change enable.
                          'INTF'   : 0x0E, # Interrupt flag.
+                         'INTCAP' : 0x10, # Interrupt captured pin state.
                          'INTCON' : 0x08, # Interupt compare mode.
                          'DEFVAL' : 0x06, # Interupt compare default.
                          'IOCON'  : 0x0A} # Configuration.
@@ -96,13 +113,14 @@ class MCP23017(_MCP):
 class MCP23008(_MCP):
     # MCP23008 8 bit port expander.
 
-    def __init__(self, I2C_bus=1, interrupt_pin='X5', addr=0x20):
-        super().__init__(I2C_bus, interrupt_pin, addr)
+    def __init__(self, I2C_bus=1, interrupt_pin='X5', addr=0x20, use_INTCAP=False):
+        super().__init__(I2C_bus, interrupt_pin, addr, use_INTCAP)
         self.reg_addr = {                 # Register memory addresses.
                          'IODIR'  : 0x00, # Input / output direction.
                          'GPIO'   : 0x09, # Pin state.
                          'GPINTEN': 0x02, # Interrupt on change enable.
                          'INTF'   : 0x07, # Interrupt flag.
+                         'INTCAP' : 0x08, # Interrupt captured pin state.
                          'INTCON' : 0x04, # Interupt compare mode.
                          'DEFVAL' : 0x03, # Interupt compare default.
                          'IOCON'  : 0x05} # Configuration.
@@ -6,11 +6,11 @@ from collections import OrderedDict
 
 from pyqtgraph.Qt import QtGui, QtCore
 from serial import SerialException
-from concurrent.futures import ThreadPoolExecutor
 
-from config.gui_settings import  update_interval
+from config.gui_settings import  update_interval, reader_thread
 from config.paths import dirs
 from com.pycboard import Pycboard, PyboardError
+from com.board_manager import Board_manager
 from com.data_logger import Data_logger
 from gui.plotting import Experiment_plot
 from gui.dialogs import Variables_dialog, Summary_variables_dialog
@@ -56,6 +56,7 @@ class Run_experiment_tab(QtGui.QWidget):
         self.Vlayout.addWidget(self.scroll_area)
 
         self.subjectboxes = []
+        self.board_manager = Board_manager() # Runs operations on all boards concurrently.
 
         self.update_timer = QtCore.QTimer() # Timer to regularly call update() during run.        
         self.update_timer.timeout.connect(self.update)
@@ -63,16 +64,24 @@ class Run_experiment_tab(QtGui.QWidget):
     # Functions used for multithreaded task setup.
 
     def thread_map(self, func):
-        '''Map func over range(self.n_setups) using seperate threads for each call.
-        Used to run experiment setup functions on all boards in parallel. Print 
-        output is delayed during multithreaded operations to avoid error message
+        '''Map func over range(self.n_setups) using the board manager to run the calls
+        concurrently. Used to run experiment setup functions on all boards in parallel.
+        Calls are not timed out as connecting, which may sync the framework, and task 
+        setup can take a long time on working boards. Setups where the call raises an
+        exception are marked as failed. 
+        Print output is delayed during multithreaded operations to avoid error message
         when trying to call PyQt method from annother thread.'''
         for subject_box in self.subjectboxes:
             subject_box.start_delayed_print()
-        with ThreadPoolExecutor(max_workers=self.n_setups) as executor:
-            return_value = executor.map(func, range(self.n_setups))
+        return_value = self.board_manager.run(self.board_manager.map(func, range(self.n_setups), timeout=None))
         for subject_box in self.subjectboxes:
             subject_box.end_delayed_print()
+        for i, rv in enumerate(return_value):
+            if isinstance(rv, Exception):
+                self.subjectboxes[i].print_to_log('\nError: ' + (str(rv) or 'timed out.'))
+                self.subjectboxes[i].error()
+                self.setup_failed[i] = True
+                return_value[i] = None
         return return_value
 
     def connect_to_board(self, i):
@@ -220,10 +229,10 @@ class Run_experiment_tab(QtGui.QWidget):
                     return
                 QtGui.QMessageBox.question(self, 'Hardware test', 
                     'Press OK when finished with hardware test.', QtGui.QMessageBox.Ok)
+                self.board_manager.run(self.board_manager.stop_framework(self.boards, process_data=False))
+                time.sleep(0.05)
                 for i, board in enumerate(self.boards):
                     try:
-                        board.stop_framework()
-                        time.sleep(0.05)
                         board.process_data()
                     except PyboardError as e:
                         self.setup_failed[i] = True
@@ -286,8 +295,8 @@ class Run_experiment_tab(QtGui.QWidget):
     def stop_experiment(self):
         self.update_timer.stop()
         self.GUI_main.refresh_timer.start(self.GUI_main.refresh_interval)
+        time.sleep(0.05)
         for i, board in enumerate(self.boards):
-            time.sleep(0.05)
             board.process_data()
         # Summary and persistent variables.
         summary_variables = [v for v in self.experiment['variables'] if v['summary']]
@@ -322,11 +331,12 @@ class Run_experiment_tab(QtGui.QWidget):
         '''Called if an error occurs while the experiment is being set up.'''
         self.update_timer.stop()
         self.GUI_main.refresh_timer.start(self.GUI_main.refresh_interval)
+        running = [board for board in self.boards if board and board.framework_running]
+        self.board_manager.run(self.board_manager.stop_framework(running, process_data=False))
+        time.sleep(0.05)
         for i, board in enumerate(self.boards):
-            # Stop running boards.
-            if board and board.framework_running:
-                board.stop_framework()
-                time.sleep(0.05)
+            # Process data from stopped boards.
+            if board in running:
                 board.process_data()
                 self.subjectboxes[i].stop_task()
         msg = QtGui.QMessageBox()
@@ -483,7 +493,7 @@ class Subjectbox(QtGui.QGroupBox):
             for v_name, v_value, pv in self.board.variables_set_pre_run:
                 board.data_logger.data_file.write('V 0 {} {}\n'.format(v_name, v_value))
         board.data_logger.data_file.write('\n')
-        board.start_framework()
+        board.start_framework(reader_thread=reader_thread)
 
         self.start_stop_button.setText('Stop')
         self.start_stop_button.setIcon(QtGui.QIcon("gui/icons/stop.svg"))
@@ -8,7 +8,7 @@ from com.pycboard import Pycboard, PyboardError, _djb2_file
 from com.data_logger import Data_logger
 
 from config.paths import dirs
-from config.gui_settings import update_interval
+from config.gui_settings import update_interval, reader_thread
 
 from gui.dialogs import *
 from gui.markov_gui.markov_variable_dialog import *
@@ -356,7 +356,7 @@ class Run_task_tab(QtGui.QWidget):
             self.data_logger.copy_task_file(self.data_dir, dirs['tasks'], 'run_task-task_files')
         self.fresh_task = False
         self.running = True
-        self.board.start_framework()
+        self.board.start_framework(reader_thread=reader_thread)
         self.task_plot.run_start(recording)
         self.task_select.setEnabled(False)
         self.upload_button.setEnabled(False)
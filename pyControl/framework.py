@@ -1,4 +1,6 @@
+import gc
 from array import array
+from heapq import heappush, heappop, heapify
 import pyb
 from . import hardware as hw
 
@@ -14,10 +16,14 @@ print_typ = const(4) # User print.
 hardw_typ = const(5) # Harware callback
 stopf_typ = const(6) # Stop framework.
 varbl_typ = const(7) # Variable change.
+profl_typ = const(8) # Profiler report.
+gcinf_typ = const(9) # Garbage collection telemetry.
+frame_typ = const(10) # Camera frame checkpoint.
+cancd_typ = const(0) # Cancelled timer.
 
-# Generic event tuple format used by Event_queue and Timer class: (timestamp, event_type, event_data)
+# Generic event format used by Event_queue and Timer class: (timestamp, event_type, event_data)
 
-# Specific event tuple types:
+# Specific event types:
 
 # (time, event_typ, event_ID)       # External event.
 # (time, state_typ, state_ID)       # State transition.
@@ -26,93 +32,486 @@ varbl_typ = const(7) # Variable change.
 # (time, hardw_typ, hardware_ID)    # Harware callback
 # (time, stopf_typ, None)           # Stop framework.
 # (time, varbl_typ, (v_name, v_str) # Variable changed.
+# (time, profl_typ, 0)              # Profiler report.
+# (time, gcinf_typ, 0)              # Garbage collection telemetry.
+# (time, frame_typ, (event_ID, frame_number)) # Camera frame checkpoint.
 
 # Event_queue -----------------------------------------------------------------
 
-class Event_queue():  
-    # First-in first-out event queue.
-    def __init__(self):
+class Event_queue():
+    # First-in first-out event queue implemented as a ring buffer of preallocated
+    # arrays storing the timestamp, type and ID of each event, and the microsecond
+    # timestamp of events generated by interrupts when us_timestamps is True (-1
+    # otherwise).  Event data which is not an integer ID (print strings, variable
+    # and frame checkpoint tuples) is stored in a preallocated list.  Rather than returning a tuple, get()
+    # copies the oldest event into the timestamp, event_type, event_data and
+    # timestamp_us attributes, so putting and getting events does not allocate memory.
+    # If the queue is full new events are dropped and counted in n_dropped, which is
+    # reported to the computer at the end of the run.  Interrupts are disabled while
+    # the queue is updated so events can be put from ISRs.
+    def __init__(self, buffer_length=50):
+        self.buffer_length = buffer_length
+        self.timestamps  = array('i', [0] * buffer_length)
+        self.event_types = array('i', [0] * buffer_length)
+        self.event_IDs   = array('i', [0] * buffer_length)
+        self.timestamps_us = array('i', [0] * buffer_length)
+        self.event_objs  = [None] * buffer_length # Non-integer event data.
         self.reset()
 
     def reset(self):
         # Empty queue.
-        self.Q = []
+        for i in range(self.buffer_length):
+            self.event_objs[i] = None
+        self.read_ind  = 0
+        self.write_ind = 0
+        self.n_queued  = 0
+        self.n_dropped = 0
         self.available = False
-
-    def put(self, event_tuple):
-        # Put event in queue.  
-        self.Q.append(event_tuple)
-        self.available = True
-
+        self.timestamp  = 0
+        self.event_type = 0
+        self.event_data = None
+        self.timestamp_us = -1
+
+    @micropython.native
+    def put(self, timestamp: int, event_type: int, event_data, timestamp_us=-1):
+        # Put event in queue.
+        irq_state = pyb.disable_irq()
+        if self.n_queued == self.buffer_length: # Queue full, drop event.
+            self.n_dropped += 1
+        else:
+            i = self.write_ind
+            self.timestamps[i]  = timestamp
+            self.event_types[i] = event_type
+            self.timestamps_us[i] = timestamp_us
+            if event_type in (print_typ, varbl_typ, stopf_typ, frame_typ):
+                self.event_objs[i] = event_data
+            else:
+                self.event_IDs[i] = event_data
+            self.write_ind = (i + 1) % self.buffer_length
+            self.n_queued += 1
+            self.available = True
+        pyb.enable_irq(irq_state)
+
+    @micropython.native
     def get(self):
-        # Get event tuple from queue
-        self.available = len(self.Q) > 1
-        return(self.Q.pop(0))
+        # Copy oldest event in queue to attributes timestamp, event_type and event_data.
+        i = self.read_ind
+        self.timestamp  = self.timestamps[i]
+        self.event_type = self.event_types[i]
+        self.timestamp_us = self.timestamps_us[i]
+        if self.event_type in (print_typ, varbl_typ, stopf_typ, frame_typ):
+            self.event_data = self.event_objs[i]
+            self.event_objs[i] = None
+        else:
+            self.event_data = self.event_IDs[i]
+        self.read_ind = (i + 1) % self.buffer_length
+        irq_state = pyb.disable_irq()
+        self.n_queued -= 1
+        self.available = self.n_queued > 0
+        pyb.enable_irq(irq_state)
+
+    def next_type(self):
+        # Return event type of oldest event in queue without removing it.
+        return self.event_types[self.read_ind]
+
+    def next_timestamp_us(self):
+        # Return microsecond timestamp of oldest event in queue without removing it.
+        return self.timestamps_us[self.read_ind]
 
 # Timer -----------------------------------------------------------------------
 
 class Timer():
+    # Timers are stored as entries [trigger_time, set_order, event_type, event_data] in
+    # a binary heap ordered by trigger time, so setting a timer and getting the next
+    # elapsed timer are O(log n). Active user timers are indexed by event_ID and other
+    # timers by event type, so timers for a given event are found without searching
+    # the heap.  Disarmed and paused timers are marked as cancelled and discarded when
+    # they reach the top of the heap.  Discarded entries are reused by set().
 
     def __init__(self):
         self.reset()
 
     def reset(self):
-        self.active_timers = [] # list of event tuples: (trigger_time, event_type, data)
-        self.paused_timers = [] # list of event tuples: (trigger_time, event_type, data)
+        self.heap = []          # Binary heap of timer entries.
+        self.ID_index = {}      # {event_ID: [entries]} for active user timers.
+        self.type_index = {}    # {event_type: [entries]} for other active timers.
+        self.paused_timers = {} # {event_ID: [(time_remaining, event_type)]}
+        self.free_entries = []  # Discarded entries available for reuse.
+        self.n_cancelled = 0    # Number of cancelled entries in heap.
+        self.n_set = 0          # Number of timers set, orders timers with same trigger time.
         self.available = False
-    
+        self.timestamp  = 0     # Trigger time of last timer returned by get().
+        self.event_type = 0     # Event type of last timer returned by get().
+        self.event_data = None  # Event data of last timer returned by get().
+
+    def _index(self, event_type, event_data):
+        # Return list of active entries for timers with specified type and data.
+        if event_type in (event_typ, timer_typ):
+            index = self.ID_index
+            key = event_data
+        else:
+            index = self.type_index
+            key = event_type
+        entries = index.get(key)
+        if entries is None:
+            entries = []
+            index[key] = entries
+        return entries
+
     def set(self, interval, event_type, event_data):
         # Set a timer to trigger specified event after 'interval' ms has elapsed.
         global current_time
-        self.active_timers.append((current_time+int(interval), event_type, event_data))
-        self.active_timers.sort(reverse=True)
+        self._push(current_time+int(interval), event_type, event_data)
+
+    def _push(self, trigger_time, event_type, event_data):
+        # Add timer entry to heap and index.
+        if self.free_entries:
+            entry = self.free_entries.pop()
+            entry[0] = trigger_time
+            entry[1] = self.n_set
+            entry[2] = event_type
+            entry[3] = event_data
+        else:
+            entry = [trigger_time, self.n_set, event_type, event_data]
+        self.n_set += 1
+        heappush(self.heap, entry)
+        self._index(event_type, event_data).append(entry)
+        if tickless and self.heap[0] is entry: # New earliest deadline.
+            _set_clock(trigger_time)
+
+    def _cancel(self, entry):
+        # Mark entry as cancelled, it is discarded when it reaches the top of the heap.
+        entry[2] = cancd_typ
+        entry[3] = None
+        self.n_cancelled += 1
+
+    def _discard_cancelled(self):
+        # Remove cancelled entries from top of heap, rebuild heap if over half
+        # of entries are cancelled.
+        if self.n_cancelled > 16 and 2*self.n_cancelled > len(self.heap):
+            self.free_entries += [e for e in self.heap if e[2] == cancd_typ]
+            self.heap = [e for e in self.heap if e[2] != cancd_typ]
+            heapify(self.heap)
+            self.n_cancelled = 0
+        while self.heap and self.heap[0][2] == cancd_typ:
+            self.free_entries.append(heappop(self.heap))
+            self.n_cancelled -= 1
 
     def check(self):
         #Check whether timers have triggered.
         global current_time, check_timers
-        self.available = bool(self.active_timers) and (self.active_timers[-1][0] <= current_time)
+        self._discard_cancelled()
+        self.available = bool(self.heap) and (self.heap[0][0] <= current_time)
         check_timers = False
 
     def get(self):
-        # Get first timer event.
+        # Get first timer event, copying it to attributes timestamp, event_type and event_data.
         global current_time
-        event_tuple = self.active_timers.pop()
-        self.available = bool(self.active_timers) and (self.active_timers[-1][0] <= current_time)
-        return event_tuple
+        self._discard_cancelled()
+        if not (self.heap and self.heap[0][0] <= current_time): # Timer disarmed since check.
+            self.available = False
+            self.event_type = cancd_typ
+            return
+        entry = heappop(self.heap)
+        self.timestamp  = entry[0]
+        self.event_type = entry[2]
+        self.event_data = entry[3]
+        self._index(entry[2], entry[3]).remove(entry)
+        entry[3] = None
+        self.free_entries.append(entry)
+        self._discard_cancelled()
+        self.available = bool(self.heap) and (self.heap[0][0] <= current_time)
 
     def disarm(self, event_ID):
         # Remove all user timers with specified event_ID.
-        self.active_timers = [t for t in self.active_timers 
-                              if not (t[2] == event_ID and (t[1] in (event_typ, timer_typ)))]
-        self.paused_timers = [t for t in self.paused_timers if not t[2] == event_ID]
+        entries = self.ID_index.get(event_ID)
+        if entries:
+            for entry in entries:
+                self._cancel(entry)
+            entries.clear()
+        if event_ID in self.paused_timers:
+            del self.paused_timers[event_ID]
 
     def pause(self, event_ID):
         # Pause all user timers with specified event_ID.
         global current_time
-        self.paused_timers += [(t[0]-current_time,t[1], t[2]) for t in self.active_timers 
-                               if (t[2] == event_ID and (t[1] in (event_typ, timer_typ)))]
-        self.active_timers = [t for t in self.active_timers 
-                              if not (t[2] == event_ID and (t[1] in (event_typ, timer_typ)))]
+        entries = self.ID_index.get(event_ID)
+        if entries:
+            paused = self.paused_timers.get(event_ID)
+            if paused is None:
+                paused = []
+                self.paused_timers[event_ID] = paused
+            for entry in entries:
+                paused.append((entry[0]-current_time, entry[2]))
+                self._cancel(entry)
+            entries.clear()
 
     def unpause(self, event_ID):
         # Unpause user timers with specified event.
         global current_time
-        self.active_timers += [(t[0]+current_time,t[1], t[2]) for t in self.paused_timers if t[2] == event_ID]
-        self.paused_timers = [t for t in self.paused_timers if not t[2] == event_ID]
-        self.active_timers.sort(reverse=True)
+        paused = self.paused_timers.pop(event_ID, None)
+        if paused:
+            for time_remaining, event_type in paused:
+                self._push(time_remaining+current_time, event_type, event_ID)
 
     def remaining(self,event_ID):
         # Return time until timer for specified event elapses, returns 0 if no timer set for event.
         global current_time
-        try:
-            return next(t[0]-current_time for t in reversed(self.active_timers) 
-                        if (t[1] == event_typ and t[2] == event_ID))
-        except StopIteration:
-            return 0
+        trigger_time = None
+        entries = self.ID_index.get(event_ID)
+        if entries:
+            for entry in entries:
+                if entry[2] == event_typ and (trigger_time is None or entry[0] < trigger_time):
+                    trigger_time = entry[0]
+        return 0 if trigger_time is None else trigger_time-current_time
 
     def disarm_type(self, event_type):
         # Disarm all active timers of a particular type.
-        self.active_timers = [t for t in self.active_timers if not t[1] == event_type]
+        if event_type in (event_typ, timer_typ):
+            for entries in self.ID_index.values():
+                for entry in entries:
+                    if entry[2] == event_type:
+                        self._cancel(entry)
+                entries[:] = [e for e in entries if e[2] != cancd_typ]
+        else:
+            entries = self.type_index.get(event_type)
+            if entries:
+                for entry in entries:
+                    self._cancel(entry)
+                entries.clear()
+
+# Profiler --------------------------------------------------------------------
+
+class Profiler():
+    # Records statistics about the framework run loop when profile is True: the number
+    # of iterations that ran each priority branch, a histogram of latency between
+    # events being put in the event queue and processed, the maximum duration of
+    # event processing in each state, and the maximum number of items in the
+    # interrupt, event and data output queues.
+
+    branch_names = ('idle', 'interrupts', 'events', 'check_timers', 'timers', 
+                    'serial_input', 'uart_output', 'streaming', 'data_output')
+
+    latency_bins = array('i', [100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000])
+    # Upper edges of latency histogram bins (us), the last bin is latencies above 50 ms.
+
+    def __init__(self):
+        self.branch_counts = array('i', [0] * len(self.branch_names))
+        self.latency_hist  = array('i', [0] * (len(self.latency_bins) + 1))
+        self.high_water    = array('i', [0, 0, 0])
+        self.handler_max   = {} # {state_name: max duration (us)}
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.branch_counts)):
+            self.branch_counts[i] = 0
+        for i in range(len(self.latency_hist)):
+            self.latency_hist[i] = 0
+        for i in range(len(self.high_water)):
+            self.high_water[i] = 0
+        self.handler_max = {}
+        self.iteration_start_us = 0
+        self.iteration_state = None
+        self.last_report = 0
+
+    def start_iteration(self):
+        # Called at start of each run loop iteration.
+        self.iteration_start_us = pyb.micros()
+        self.iteration_state = state_machine.current_state
+        if hw.interrupt_queue.n_queued > self.high_water[0]:
+            self.high_water[0] = hw.interrupt_queue.n_queued
+        if event_queue.n_queued > self.high_water[1]:
+            self.high_water[1] = event_queue.n_queued
+        if data_output_queue.n_queued > self.high_water[2]:
+            self.high_water[2] = data_output_queue.n_queued
+
+    def end_iteration(self, branch):
+        # Called at end of each run loop iteration with the priority of the branch that ran.
+        self.branch_counts[branch] += 1
+        if branch in (2, 4): # Event or timer processed.
+            duration = pyb.elapsed_micros(self.iteration_start_us)
+            if duration > self.handler_max.get(self.iteration_state, 0):
+                self.handler_max[self.iteration_state] = duration
+        if profile_interval and current_time - self.last_report >= profile_interval:
+            self.last_report = current_time
+            data_output_queue.put(current_time, profl_typ, 0)
+
+    def event_dispatched(self, timestamp, timestamp_us):
+        # Add latency between event timestamp and processing to histogram.
+        if timestamp_us >= 0:
+            latency = (time_now_us() - timestamp_us) & 0x3FFFFFFF
+        else:
+            latency = 1000*(time_now() - timestamp)
+        i = 0
+        while i < len(self.latency_bins) and latency > self.latency_bins[i]:
+            i += 1
+        self.latency_hist[i] += 1
+
+    def report(self):
+        # Return string representation of profiling data.
+        return repr({
+            'branch_counts': {name: n for name, n in zip(self.branch_names, self.branch_counts)},
+            'latency_bins_us': list(self.latency_bins),
+            'latency_hist': list(self.latency_hist),
+            'handler_max_us': self.handler_max,
+            'high_water': {'interrupt_queue'  : self.high_water[0],
+                           'event_queue'      : self.high_water[1],
+                           'data_output_queue': self.high_water[2]},
+            'interrupts_dropped': hw.interrupt_queue.n_dropped})
+
+# Garbage collection ----------------------------------------------------------
+
+class GC_scheduler():
+    # Runs garbage collection in idle run loop iterations when free memory falls below
+    # gc_threshold, so automatic collections triggered by a failed allocation are 
+    # unlikely to delay processing of events.  The duration of each collection is
+    # recorded and telemetry is sent to the computer after each collection and at
+    # the end of the run.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n_collections = 0
+        self.last_pause  = 0 # Duration of most recent collection (us).
+        self.max_pause   = 0 # Maximum duration of collection (us).
+        self.total_pause = 0 # Summed duration of collections (us).
+        self.last_check  = -1 # Time free memory was last checked (ms).
+
+    def check(self):
+        # Called in idle run loop iterations, collect garbage if free memory is below
+        # gc_threshold.  Free memory is checked at most once per millisecond.
+        if current_time == self.last_check:
+            return
+        self.last_check = current_time
+        if gc.mem_free() < gc_threshold:
+            self.collect()
+
+    def collect(self):
+        # Collect garbage, record duration and queue telemetry for output.
+        start = pyb.micros()
+        gc.collect()
+        self.last_pause = pyb.elapsed_micros(start)
+        self.n_collections += 1
+        self.total_pause += self.last_pause
+        if self.last_pause > self.max_pause:
+            self.max_pause = self.last_pause
+        data_output_queue.put(current_time, gcinf_typ, 0)
+
+    def report(self):
+        # Return string representation of garbage collection telemetry.
+        return repr({
+            'n_collections': self.n_collections,
+            'last_pause_us': self.last_pause,
+            'max_pause_us' : self.max_pause,
+            'mean_pause_us': self.total_pause // self.n_collections if self.n_collections else 0,
+            'mem_free'     : gc.mem_free(),
+            'mem_alloc'    : gc.mem_alloc()})
+
+# Serial input ----------------------------------------------------------------
+
+class Serial_input():
+    # Incremental parser for commands sent from the computer.  Each call to process 
+    # reads only the bytes available on the serial line, partially received commands
+    # are kept across calls and dispatched once complete, so slow serial input never
+    # blocks the run loop.  Command formats:
+    # Single byte commands: '\x03' stop, 'B', 'T', 'S', 'P' base station, 'R' profiler.
+    # Commands with data: 'V' variable or 'C' cerebro command byte, followed by data
+    # length (2 bytes), data (variable) and checksum (2 bytes).
+
+    timeout = 1000 # Partially received commands are discarded after timeout (ms).
+
+    def __init__(self, buffer_length=256):
+        self.buffer = bytearray(buffer_length)
+        self.buffer_mv = memoryview(self.buffer)
+        self.reset()
+
+    def reset(self):
+        self.command = None # Command byte of partially received command.
+        self.data_len = -1 # Data length of partially received command, -1 if not yet read.
+        self.n_read = 0 # Number of bytes read of current field.
+        self.n_required = 0 # Number of bytes required to complete current field.
+        self.start_time = 0 # Time command started being received.
+
+    def process(self):
+        # Read available bytes from computer, dispatch command if complete.
+        global running
+        if self.command and (current_time - self.start_time) > self.timeout:
+            self.reset() # Discard incomplete command.
+        if not self.command: # Read command byte.
+            command = usb_serial.read(1)
+            if not command:
+                return
+            if command in (b'V', b'C'): # Command with data, read data length next.
+                self.command = command
+                self.data_len = -1
+                self.n_read = 0
+                self.n_required = 2
+                self.start_time = current_time
+            elif command == b'\x03': # Serial command to stop run.
+                running = False
+            else:
+                self._process_command(command)
+            return
+        n = usb_serial.readinto(self.buffer_mv[self.n_read:self.n_required])
+        if n:
+            self.n_read += n
+        if self.n_read < self.n_required:
+            return # Wait for more bytes.
+        if self.data_len == -1: # Data length read, read data and checksum next.
+            self.data_len = int.from_bytes(self.buffer[:2], 'little')
+            if self.data_len + 2 > len(self.buffer):
+                self.buffer = bytearray(self.data_len + 2)
+                self.buffer_mv = memoryview(self.buffer)
+            self.n_read = 0
+            self.n_required = self.data_len + 2
+            return
+        checksum = self.buffer[self.data_len] | (self.buffer[self.data_len+1] << 8)
+        if checksum == sum(self.buffer_mv[:self.data_len]) & 0xFFFF:
+            self._process_command(self.command, bytes(self.buffer_mv[:self.data_len]))
+        self.reset()
+
+    def _process_command(self, command, data=b''):
+        # Process complete command from computer.
+        if command == b'V': # Get/set variables command.
+            if data[-1:] == b's': # Set variable.
+                v_name, v_str = data[:-1].decode().split(' ', 1)
+                if state_machine._set_variable(v_name, v_str):
+                    data_output_queue.put(current_time, varbl_typ, (v_name, v_str))
+            elif data[-1:] == b'g': # Get variable.
+                v_name = data[:-1].decode()
+                v_str = state_machine._get_variable(v_name)
+                data_output_queue.put(current_time, varbl_typ, (v_name, v_str))
+        elif command == b'C': # Cerebro command
+            if data[-1:] == b'd': # Set diode powers.
+                diode_parameters = data[:-1].decode()[1:-1] # remove ' at beginning and end
+                msg = 'D,' + diode_parameters + '\n'
+                state_machine.smd.hw.BaseStation.write(msg)
+            elif data[-1:] == b'w': # Set waveform.
+                wave_parameters = data[:-1].decode()[1:-1] # remove ' at beginning and end
+                msg = 'W,' + wave_parameters + '\n'
+                state_machine.smd.hw.BaseStation.write(msg)
+            elif data[-1:] == b'n': # Set radio channel.
+                new_channel = data[:-1].decode()
+                msg = 'K,' + new_channel + '\n'
+                state_machine.smd.hw.BaseStation.write(msg)
+            elif data[-1:] == b's': # Set cerebro serial number.
+                new_channel = data[:-1].decode()
+                msg = 'S,' + new_channel + '\n'
+                state_machine.smd.hw.BaseStation.write(msg)
+        elif command == b'B': # Request battery info from cerebro
+            msg = 'B\n'
+            state_machine.smd.hw.BaseStation.write(msg)
+        elif command == b'T': # Invoke base station device's trigger
+            state_machine.smd.hw.BaseStation.trigger()
+        elif command == b'S': # Invoke base station device's stop
+            state_machine.smd.hw.BaseStation.stop()
+        elif command == b'R': # Request profiler report.
+            if profile:
+                data_output_queue.put(current_time, profl_typ, 0)
+        elif command == b'P': # Blink Base Station
+            msg = 'P\n'
+            state_machine.smd.hw.BaseStation.write(msg)
 
 # Framework variables and objects ---------------------------------------------
 
@@ -120,18 +519,48 @@ state_machine = None  # State machine object.
 
 timer = Timer()  # Instantiate timer_array object.
 
-event_queue = Event_queue() # Instantiate event que object.
+event_queue = Event_queue(buffer_length=50) # Instantiate event que object.
 
-data_output_queue = Event_queue() # Queue used for outputing events to serial line.
+data_output_queue = Event_queue(buffer_length=200) # Queue used for outputing events to serial line.
 
 data_output = True  # Whether to output data to the serial line.
 
+batch_output = False # Whether to output consecutive events and state changes in a single frame.
+
+batch_buffer = bytearray(256) # Buffer used to build batched event frames.
+
+batch_buffer_mv = memoryview(batch_buffer)
+
+D_frame = bytearray(b'D' + b'\x00'*8) # Buffer used to output events and state changes.
+
+U_frame = bytearray(b'U' + b'\x00'*12) # Buffer used to output events with microsecond timestamps.
+
+F_frame = bytearray(b'F' + b'\x00'*12) # Buffer used to output camera frame checkpoints.
+
+string_header = bytearray(9) # Buffer used to output header of string frames.
+
 current_time = None # Time since run started (milliseconds).
 
+us_timestamps = False # Whether events generated by interrupts have microsecond timestamps.
+
+us_start = 0 # Value of pyb.micros() at the millisecond tick when run started.
+
 running = False     # Set to True when framework is running, set to False to stop run.
 
 usb_serial = pyb.USB_VCP()  # USB serial port object.
 
+serial_input = Serial_input() # Parser for commands from computer.
+
+profile = False # Whether to record run loop statistics with profiler.
+
+profile_interval = 0 # Interval between profiler reports (ms), 0 to only report on request.
+
+profiler = Profiler()
+
+gc_threshold = 0 # Collect garbage in idle iterations when free memory is below threshold (bytes), 0 to disable.
+
+gc_scheduler = GC_scheduler()
+
 states = {} # Dictionary of {state_name: state_ID}
 
 events = {} # Dictionary of {event_name: event_ID}
@@ -142,6 +571,12 @@ clock = pyb.Timer(1) # Timer which generates clock tick.
 
 check_timers = False # Flag to say timers need to be checked, set True by clock tick.
 
+tickless = False # If True clock interrupts only at timer deadlines rather than every ms.
+
+clock_deadline = None # Time the clock is set to interrupt at in tickless mode.
+
+clock_prescaler = 0 # Clock prescaler giving 10 clock counts per ms in tickless mode.
+
 start_time = 0 # Time at which framework run is started.
 
 # Framework functions ---------------------------------------------------------
@@ -152,6 +587,50 @@ def _clock_tick(timer):
     current_time = pyb.elapsed_millis(start_time)
     check_timers = True
 
+def _clock_deadline(timer):
+    # Set flag to check timers, called by hardware timer when the earliest timer 
+    # deadline is reached in tickless mode.
+    global check_timers, clock_deadline
+    timer.deinit()
+    clock_deadline = None
+    check_timers = True
+
+def _set_clock(deadline):
+    # Tickless mode: set clock to interrupt when deadline (ms) is reached, deadlines 
+    # more than 6.5 seconds ahead interrupt early and the clock is set again.
+    global check_timers, clock_deadline
+    clock_deadline = deadline
+    delay = deadline - pyb.elapsed_millis(start_time)
+    if delay <= 0:
+        check_timers = True
+    else:
+        clock.init(prescaler=clock_prescaler, period=min(10*delay, 0xFFFF), 
+                   callback=_clock_deadline)
+
+def _idle():
+    # Tickless mode: called when no queue has work, sets flag if a timer is due,
+    # otherwise ensures clock is set for next deadline and waits for an interrupt.
+    global check_timers
+    if timer.heap:
+        if timer.heap[0][0] <= current_time:
+            check_timers = True
+            return
+        elif clock_deadline is None:
+            _set_clock(timer.heap[0][0])
+    pyb.wfi()
+
+def time_now_us():
+    # Return time since run started (us) modulo 2**30, used to timestamp interrupts
+    # when us_timestamps is True.
+    return pyb.elapsed_micros(us_start)
+
+def time_now():
+    # Return time since run started (ms). Used by interrupt service routines as
+    # current_time is only updated between event handlers in tickless mode.
+    if tickless:
+        return pyb.elapsed_millis(start_time)
+    return current_time
+
 def register_machine(sm):
     global state_machine, states, events, ID2name
     # Adds state machine states and events to framework states and events dicts,
@@ -186,136 +665,242 @@ def get_variables():
     # Print state machines variables as dict {v_name: repr(v_value)}
     print({k: repr(v) for k, v in state_machine.smd.v.__dict__.items()})
 
-def output_data(event):
-    # Output data to computer.
-    if event[1] in  (event_typ, state_typ): # send event or state change.
-        timestamp = event[0].to_bytes(4, 'little') 
-        ID        = event[2].to_bytes(2, 'little')
-        checksum  = sum(timestamp + ID).to_bytes(2, 'little') 
-        usb_serial.send(b'D' + timestamp + ID + checksum)
-    elif event[1] in (print_typ, varbl_typ): # send user generated output string.
-        if event[1] == print_typ: # send user generated output string.
-            start_byte = b'P'
-            data_bytes = event[2].encode()
-        elif event[1] == varbl_typ: # Variable changed.
-            start_byte = b'V'
-            data_bytes = event[2][0].encode() + b' ' + event[2][1].encode()
-        data_len = len(data_bytes).to_bytes(2, 'little')  
-        timestamp = event[0].to_bytes(4, 'little')
-        checksum  = (sum(data_len + timestamp) + sum(data_bytes)).to_bytes(2, 'little')
-        usb_serial.send(start_byte + data_len + timestamp + checksum + data_bytes)
-
-def receive_data():
-    # Read and process data from computer.
-    global running
-    new_byte = usb_serial.read(1) 
-    if new_byte == b'\x03': # Serial command to stop run.
-        running = False
-    elif new_byte == b'V': # Get/set variables command.
-        data_len = int.from_bytes(usb_serial.read(2), 'little')
-        data = usb_serial.read(data_len)
-        checksum = int.from_bytes(usb_serial.read(2), 'little')
-        if not checksum == (sum(data) & 0xFFFF):
-            return  # Bad checksum.
-        if data[-1:] == b's': # Set variable.
-            v_name, v_str = eval(data[:-1])
-            if state_machine._set_variable(v_name, v_str):
-                data_output_queue.put((current_time, varbl_typ, (v_name, v_str)))
-        elif data[-1:] == b'g': # Get variable.
-            v_name = data[:-1].decode()
-            v_str = state_machine._get_variable(v_name)
-            data_output_queue.put((current_time, varbl_typ, (v_name, v_str)))
-    elif new_byte == b'C': # Cerebro command
-        data_len = int.from_bytes(usb_serial.read(2), 'little')
-        data = usb_serial.read(data_len)
-        checksum = int.from_bytes(usb_serial.read(2), 'little')
-        if not checksum == (sum(data) & 0xFFFF):
-            return  # Bad checksum.
-        if data[-1:] == b'd': # Set variable.
-            diode_parameters = data[:-1].decode()[1:-1] # remove ' at beginning and end
-            msg = 'D,' + diode_parameters + '\n'
-            state_machine.smd.hw.BaseStation.uart.write(msg)
-        elif data[-1:] == b'w': # Set variable.
-            wave_parameters = data[:-1].decode()[1:-1] # remove ' at beginning and end
-            msg = 'W,' + wave_parameters + '\n'
-            state_machine.smd.hw.BaseStation.uart.write(msg)
-        elif data[-1:] == b'n': # Set variable.
-            new_channel = data[:-1].decode() # remove ' at beginning and end
-            msg = 'K,' + new_channel + '\n'
-            state_machine.smd.hw.BaseStation.uart.write(msg)
-        elif data[-1:] == b's': # Set variable.
-            new_channel = data[:-1].decode() # remove ' at beginning and end
-            msg = 'S,' + new_channel + '\n'
-            state_machine.smd.hw.BaseStation.uart.write(msg)
-    elif new_byte == b'B': # Request battery info from cerebro
-        msg = 'B\n'
-        state_machine.smd.hw.BaseStation.uart.write(msg)
-    elif new_byte == b'T': # Invoke base station device's trigger
-        state_machine.smd.hw.BaseStation.trigger()
-    elif new_byte == b'S': # Invoke base station device's stop
-        state_machine.smd.hw.BaseStation.stop()
-    elif new_byte == b'P': # Blink Base Station
-        msg = 'P\n'
-        state_machine.smd.hw.BaseStation.uart.write(msg)
+@micropython.native
+def write_int(buf, i, x, n_bytes):
+    # Write integer x to buf starting at index i as n_bytes little endian bytes,
+    # return sum of the bytes written for use in checksums.
+    byte_sum = 0
+    for j in range(n_bytes):
+        b = (x >> (8*j)) & 0xFF
+        buf[i+j] = b
+        byte_sum += b
+    return byte_sum
+
+def output_data(timestamp, event_type, event_data, timestamp_us=-1):
+    # Output data to computer. Event, state and frame checkpoint frames are written
+    # into preallocated buffers so outputting them does not allocate memory.
+    if event_type == event_typ and timestamp_us >= 0: # send event with microsecond timestamp.
+        output_data_us(timestamp, event_data, timestamp_us)
+    elif event_type == frame_typ: # send camera frame checkpoint.
+        output_frame_checkpoint(timestamp, *event_data)
+    elif event_type in  (event_typ, state_typ): # send event or state change.
+        checksum  = write_int(D_frame, 1, timestamp, 4)
+        checksum += write_int(D_frame, 5, event_data, 2)
+        write_int(D_frame, 7, checksum, 2)
+        usb_serial.send(D_frame)
+    elif event_type in (print_typ, varbl_typ, profl_typ, gcinf_typ): # send output string.
+        # String frames still allocate: the text is built by str formatting before it
+        # reaches the output path and has no fixed length, so it is encoded here rather
+        # than copied into a preallocated buffer.  Only the header is preallocated.
+        if event_type == print_typ: # send user generated output string.
+            string_header[0] = 80 # 'P'
+            data_bytes = event_data.encode()
+        elif event_type == varbl_typ: # Variable changed.
+            string_header[0] = 86 # 'V'
+            data_bytes = event_data[0].encode() + b' ' + event_data[1].encode()
+        elif event_type == profl_typ: # Profiler report.
+            string_header[0] = 82 # 'R'
+            data_bytes = profiler.report().encode()
+        elif event_type == gcinf_typ: # Garbage collection telemetry.
+            string_header[0] = 71 # 'G'
+            data_bytes = gc_scheduler.report().encode()
+        checksum  = write_int(string_header, 1, len(data_bytes), 2)
+        checksum += write_int(string_header, 3, timestamp, 4)
+        checksum += sum(data_bytes)
+        write_int(string_header, 7, checksum, 2)
+        usb_serial.send(string_header)
+        usb_serial.send(data_bytes)
+
+def output_data_us(timestamp, event_ID, timestamp_us):
+    # Output event with microsecond timestamp to computer. Serial data format: 'U t i u k'
+    # U character indicating event with microsecond timestamp (1 byte)
+    # t timestamp (ms) (4 bytes)
+    # i event ID (2 bytes)
+    # u time since run start (us) modulo 2**30 (4 bytes)
+    # k checksum (2 bytes)
+    checksum  = write_int(U_frame, 1, timestamp, 4)
+    checksum += write_int(U_frame, 5, event_ID, 2)
+    checksum += write_int(U_frame, 7, timestamp_us, 4)
+    write_int(U_frame, 11, checksum, 2)
+    usb_serial.send(U_frame)
+
+def output_frame_checkpoint(timestamp, event_ID, frame_number):
+    # Output camera frame checkpoint to computer. Serial data format: 'F t i n k'
+    # F character indicating frame checkpoint (1 byte)
+    # t timestamp of frame (ms) (4 bytes)
+    # i frame event ID (2 bytes)
+    # n frame number (4 bytes)
+    # k checksum (2 bytes)
+    checksum  = write_int(F_frame, 1, timestamp, 4)
+    checksum += write_int(F_frame, 5, event_ID, 2)
+    checksum += write_int(F_frame, 7, frame_number, 4)
+    write_int(F_frame, 11, checksum, 2)
+    usb_serial.send(F_frame)
+
+def put_varint(buf, i, x):
+    # Write signed integer x to buf starting at index i as a zigzag encoded 
+    # varint, return index following varint.
+    x = x << 1 if x >= 0 else ((-x) << 1) - 1
+    while x > 0x7F:
+        buf[i] = (x & 0x7F) | 0x80
+        x >>= 7
+        i += 1
+    buf[i] = x
+    return i + 1
+
+def output_batch():
+    # Output consecutive events and state changes from the data_output_queue to computer
+    # in a single frame.  Serial data format: 'E l t k D' where:
+    # E character indicating start of batch (1 byte)
+    # l length of data in bytes (2 bytes)
+    # t timestamp of first event (4 bytes)
+    # k checksum (2 bytes)
+    # D data: for each event a varint of time since previous event followed by
+    #   a varint of event ID, varints are zigzag encoded (variable)
+    data_output_queue.get()
+    timestamp = data_output_queue.timestamp
+    prev_time = timestamp
+    i = 9
+    while True:
+        i = put_varint(batch_buffer, i, data_output_queue.timestamp - prev_time)
+        i = put_varint(batch_buffer, i, data_output_queue.event_data)
+        prev_time = data_output_queue.timestamp
+        if (i > len(batch_buffer) - 10 or not data_output_queue.available or
+            not data_output_queue.next_type() in (event_typ, state_typ) or
+            data_output_queue.next_timestamp_us() >= 0):
+            break
+        data_output_queue.get()
+    batch_buffer[0] = 69 # 'E'
+    checksum  = write_int(batch_buffer, 1, i-9, 2)
+    checksum += write_int(batch_buffer, 3, timestamp, 4)
+    for j in range(9, i):
+        checksum += batch_buffer[j]
+    write_int(batch_buffer, 7, checksum, 2)
+    usb_serial.send(batch_buffer_mv[:i])
+
+def output_next():
+    # Output next item in data_output_queue to computer, in batch mode consecutive 
+    # events and state changes are output together.
+    if (batch_output and data_output_queue.next_type() in (event_typ, state_typ)
+        and data_output_queue.next_timestamp_us() < 0):
+        output_batch()
+    else:
+        data_output_queue.get()
+        output_data(data_output_queue.timestamp, data_output_queue.event_type,
+                    data_output_queue.event_data, data_output_queue.timestamp_us)
+
+def output_queue_overflows():
+    # Output a print message to computer for each event queue that dropped events.
+    for queue_name, queue in (('Event', event_queue), ('Data output', data_output_queue)):
+        if queue.n_dropped:
+            output_data(current_time, print_typ, '! {} queue overflow, {} events dropped.'
+                        .format(queue_name, queue.n_dropped))
+    for ID, n_dropped in enumerate(hw.interrupt_queue.dropped):
+        if n_dropped:
+            output_data(current_time, print_typ, '! Interrupt queue overflow, {} interrupts dropped from {} with ID {}.'
+                        .format(n_dropped, type(hw.IO_dict[ID]).__name__, ID))
 
 def run(duration=None):
     # Run framework for specified number of seconds.
     # Pre run
-    global current_time, start_time, running
+    global current_time, start_time, running, clock_deadline, clock_prescaler, us_start
     timer.reset()
     event_queue.reset()
     data_output_queue.reset()
+    profiler.reset()
+    gc_scheduler.reset()
+    serial_input.reset()
     if not hw.initialised: hw.initialise()
     current_time = 0
     hw.run_start()
     start_time = pyb.millis()
-    clock.init(freq=1000)
-    clock.callback(_clock_tick)
+    # pyb.micros() is 1000*pyb.millis() plus us since the last ms tick, modulo 2**30.
+    us_start = (1000*start_time) & 0x3FFFFFFF
+    if tickless: # Clock is set by timer when deadlines change.
+        clock_deadline = None
+        clock_prescaler = clock.source_freq()//10000 - 1
+    else: # Clock ticks every ms.
+        clock.init(freq=1000)
+        clock.callback(_clock_tick)
     usb_serial.setinterrupt(-1) # Disable 'ctrl+c' on serial raising KeyboardInterrupt.
     running = True
     state_machine._start()
     if duration: # Set timer to stop framework.
-        timer.set(duration*1000, (stopf_typ, None))
+        timer.set(duration*1000, stopf_typ, None)
     # Run
     while running:
+        if tickless:
+            current_time = pyb.elapsed_millis(start_time)
+        if profile:
+            profiler.start_iteration()
+        branch = 0 # Priority of branch run this iteration, 0 if idle.
         # Priority 1: Process hardware interrupts.
         if hw.interrupt_queue.available: 
-            hw.IO_dict[hw.interrupt_queue.get()]._process_interrupt()
+            branch = 1
+            hw.interrupt_queue.get()
+            hw.IO_dict[hw.interrupt_queue.ID]._process_interrupt(hw.interrupt_queue.timestamp,
+                hw.interrupt_queue.timestamp_us, hw.interrupt_queue.data)
         # Priority 2: Process event from queue.
         elif event_queue.available: 
-            event = event_queue.get()
-            data_output_queue.put(event)
-            state_machine._process_event(ID2name[event[2]])
+            branch = 2
+            event_queue.get()
+            data_output_queue.put(event_queue.timestamp, event_typ, event_queue.event_data,
+                                  event_queue.timestamp_us)
+            if profile:
+                profiler.event_dispatched(event_queue.timestamp, event_queue.timestamp_us)
+            state_machine._process_event_ID(event_queue.event_data)
         # Priority 3: Check for elapsed timers.
         elif check_timers:
+            branch = 3
             timer.check()
         # Priority 4: Process timer event.
         elif timer.available: 
-            event = timer.get()
-            if  event[1] == timer_typ:
-                state_machine._process_event(ID2name[event[2]])
-            elif event[1] == event_typ:
-                data_output_queue.put(event)
-                state_machine._process_event(ID2name[event[2]])
-            elif event[1] == hardw_typ:
-                hw.IO_dict[event[2]]._timer_callback()
-            elif event[1] == state_typ:
-                state_machine.goto_state(ID2name[event[2]])
-            elif event[1] == stopf_typ:
+            branch = 4
+            timer.get()
+            if  timer.event_type == timer_typ:
+                state_machine._process_event_ID(timer.event_data)
+            elif timer.event_type == event_typ:
+                data_output_queue.put(timer.timestamp, event_typ, timer.event_data)
+                state_machine._process_event_ID(timer.event_data)
+            elif timer.event_type == hardw_typ:
+                hw.IO_dict[timer.event_data]._timer_callback()
+            elif timer.event_type == state_typ:
+                state_machine.goto_state(ID2name[timer.event_data])
+            elif timer.event_type == stopf_typ:
                 running = False
         # Priority 5: Check for serial input from computer.
         elif usb_serial.any(): 
-            receive_data()
-        # Priority 6: Stream analog data.
+            branch = 5
+            serial_input.process()
+        # Priority 6: Transmit data to UART devices.
+        elif hw.uart_tx_queue.available:
+            branch = 6
+            hw.IO_dict[hw.uart_tx_queue.get()]._process_tx()
+        # Priority 7: Stream analog data.
         elif hw.stream_data_queue.available: 
+            branch = 7
             hw.IO_dict[hw.stream_data_queue.get()]._process_streaming()
-        # Priority 7: Output framework data.
+        # Priority 8: Output framework data.
         elif data_output_queue.available: 
-            output_data(data_output_queue.get())
+            branch = 8
+            output_next()
+        # Idle: collect garbage if memory is low, in tickless mode wait for interrupt.
+        else:
+            if gc_threshold:
+                gc_scheduler.check()
+            if tickless:
+                _idle()
+        if profile:
+            profiler.end_iteration(branch)
     # Post run
     usb_serial.setinterrupt(3) # Enable 'ctrl+c' on serial raising KeyboardInterrupt.
     clock.deinit()
     hw.run_stop()
     state_machine._stop()
+    if profile: # Send final profiler report.
+        data_output_queue.put(current_time, profl_typ, 0)
+    if gc_threshold: # Send final garbage collection telemetry.
+        data_output_queue.put(current_time, gcinf_typ, 0)
     while data_output_queue.available:
-        output_data(data_output_queue.get())
+        output_next()
+    output_queue_overflows()
@@ -1,4 +1,5 @@
 import pyb
+import stm
 from array import array
 from . import framework as fw
 from .utility import randint
@@ -39,6 +40,79 @@ class Ring_buffer():
             self.full = False
             return x
 
+# Interrupt queue -------------------------------------------------------------
+
+class Interrupt_queue():
+    # Queue for processing hardware interrupts, implemented as a ring buffer of 
+    # preallocated arrays storing for each interrupt the ID of the hardware object 
+    # that generated it, its timestamp, its microsecond timestamp (-1 if not used)
+    # and an integer of interrupt data (e.g. edge direction), so repeated interrupts
+    # from the same object each keep their own time.  get() copies the oldest
+    # interrupt into the ID, timestamp, timestamp_us and data attributes.  If the
+    # queue is full new interrupts are dropped and counted in n_dropped and, for
+    # each hardware object, in dropped[ID], which are reported at the end of the run.
+    # The queue length can be changed with set_length before the framework is run.
+    # Interrupts are disabled while the queue is updated as put is called from ISRs,
+    # which may preempt get or a lower priority ISR's put.
+
+    def __init__(self, buffer_length=20):
+        self.set_length(buffer_length)
+
+    def set_length(self, buffer_length):
+        # Allocate buffers to store buffer_length interrupts and empty queue.
+        self.buffer_length = buffer_length
+        self.IDs           = array('i', [0] * buffer_length)
+        self.timestamps    = array('i', [0] * buffer_length)
+        self.timestamps_us = array('i', [0] * buffer_length)
+        self.data_values   = array('i', [0] * buffer_length)
+        self.reset()
+
+    def reset(self):
+        # Empty queue and reset overflow counters.
+        self.read_ind  = 0
+        self.write_ind = 0
+        self.n_queued  = 0
+        self.n_dropped = 0
+        self.dropped = array('i', [0] * next_ID) # Interrupts dropped for each hardware ID.
+        self.available = False
+        self.ID = 0
+        self.timestamp = 0
+        self.timestamp_us = -1
+        self.data = 0
+
+    @micropython.native
+    def put(self, ID: int, timestamp: int, timestamp_us: int, data: int):
+        # Put interrupt in queue.
+        irq_state = pyb.disable_irq()
+        if self.n_queued == self.buffer_length: # Queue full, drop interrupt.
+            self.n_dropped += 1
+            if ID < len(self.dropped):
+                self.dropped[ID] += 1
+        else:
+            i = self.write_ind
+            self.IDs[i] = ID
+            self.timestamps[i] = timestamp
+            self.timestamps_us[i] = timestamp_us
+            self.data_values[i] = data
+            self.write_ind = (i + 1) % self.buffer_length
+            self.n_queued += 1
+            self.available = True
+        pyb.enable_irq(irq_state)
+
+    @micropython.native
+    def get(self):
+        # Copy oldest interrupt in queue to attributes ID, timestamp, timestamp_us and data.
+        i = self.read_ind
+        self.ID = self.IDs[i]
+        self.timestamp = self.timestamps[i]
+        self.timestamp_us = self.timestamps_us[i]
+        self.data = self.data_values[i]
+        self.read_ind = (i + 1) % self.buffer_length
+        irq_state = pyb.disable_irq()
+        self.n_queued -= 1
+        self.available = self.n_queued > 0
+        pyb.enable_irq(irq_state)
+
 # Variables -------------------------------------------------------------------
 
 next_ID = 0 # Next hardware object ID.
@@ -52,10 +126,12 @@ default_pull = {'down': [], # Used when Mainboards are initialised to specify
 
 initialised = False # Set to True once hardware has been intiialised.
 
-interrupt_queue = Ring_buffer()   # Queue for processing hardware interrupts.
+interrupt_queue = Interrupt_queue() # Queue for processing hardware interrupts.
 
 stream_data_queue = Ring_buffer() # Queue for streaming data to computer.
 
+uart_tx_queue = Ring_buffer() # Queue of UART devices with data to transmit.
+
 # Functions -------------------------------------------------------------------
 
 def assign_ID(hardware_object):
@@ -76,6 +152,7 @@ def run_start():
     # Called at start of each framework run.
     interrupt_queue.reset()
     stream_data_queue.reset()
+    uart_tx_queue.reset()
     for IO_object in IO_dict.values():
         IO_object._run_start()
 
@@ -189,17 +266,17 @@ class Digital_input(IO_object):
             self.decimate_counter = (self.decimate_counter+1) % self.decimate
             if not self.decimate_counter == 0:
                 return # Ignore input due to decimation.
-        self.interrupt_timestamp = fw.current_time
         if self.debounce: # Digital input uses debouncing.
             self.debounce_active = True
             self.pin_state = not self.pin_state
         elif self.use_both_edges:
             self.pin_state = self.pin.value()
-        interrupt_queue.put(self.ID)
+        interrupt_queue.put(self.ID, fw.time_now(), fw.time_now_us() if fw.us_timestamps else -1,
+                            self.pin_state)
 
-    def _process_interrupt(self):
+    def _process_interrupt(self, timestamp, timestamp_us, pin_state):
         # Put apropriate event for interrupt in event queue.
-        self._publish_if_edge_has_event(self.interrupt_timestamp)
+        self._publish_if_edge_has_event(pin_state, timestamp, timestamp_us)
         if self.debounce: # Set timer to deactivate debounce in self.debounce milliseconds.
             fw.timer.set(self.debounce, fw.hardw_typ, self.ID)
 
@@ -208,15 +285,15 @@ class Digital_input(IO_object):
         # if necessary publishes event for edge missed during debounce.
         if not self.pin_state == self.pin.value(): # An edge has been missed.  
             self.pin_state = not self.pin_state  
-            self._publish_if_edge_has_event(fw.current_time)
+            self._publish_if_edge_has_event(self.pin_state, fw.current_time)
         self.debounce_active = False
 
-    def _publish_if_edge_has_event(self, timestamp):
+    def _publish_if_edge_has_event(self, pin_state, timestamp, timestamp_us=-1):
         # Publish event if detected edge has event ID assigned.
-        if self.pin_state and self.rising_event_ID:          # Rising edge.
-            fw.event_queue.put((timestamp, fw.event_typ, self.rising_event_ID))
-        elif (not self.pin_state) and self.falling_event_ID: # Falling edge.
-            fw.event_queue.put((timestamp, fw.event_typ, self.falling_event_ID))
+        if pin_state and self.rising_event_ID:          # Rising edge.
+            fw.event_queue.put(timestamp, fw.event_typ, self.rising_event_ID, timestamp_us)
+        elif (not pin_state) and self.falling_event_ID: # Falling edge.
+            fw.event_queue.put(timestamp, fw.event_typ, self.falling_event_ID, timestamp_us)
 
     def value(self):
         # Return state of the input. 
@@ -226,9 +303,111 @@ class Digital_input(IO_object):
         self.debounce_active = False      # Set True when pin is ignoring inputs due to debounce.
         if self.use_both_edges:
             self.pin_state = self.pin.value()
-        self.interrupt_timestamp = 0
         self.decimate_counter = -1
 
+# Pulse counter ---------------------------------------------------------------
+
+class Pulse_counter(IO_object):
+    def __init__(self, pin, event=None, threshold=None, edge='rising', pull=None, filter=0):
+        # Pulse_counter counts edges on a pin using a hardware timer clocked by the pin
+        # (external clock mode), so edges are counted without running any Python code
+        # and the maximum input rate is not limited by interrupt overheads.  If an event
+        # is specified it is published every threshold edges, using a single timer 
+        # interrupt per threshold edges.  The number of edges counted since the start 
+        # of the run is returned by count().  The pin must be connected to channel 1 or
+        # 2 of a timer in available_timers.
+        # Arguments:
+        # pin       - micropython pin to use
+        # event     - Name of event triggered every threshold edges.
+        # threshold - Number of edges between events, at most 0x10000 (2**32 if the pin
+        #             is connected to 32 bit timer 2 or 5).
+        # edge      - 'rising' or 'falling', edge to count.
+        # pull      - used to enable internal pullup or pulldown resitors. 
+        # filter    - Timer input filter setting 0-15, higher values require the input
+        #             to be stable for longer for an edge to be counted.
+        assert edge in ('rising', 'falling'), "edge must be 'rising' or 'falling'"
+        assert (event is None) == (threshold is None), 'threshold must be specified if event is specified.'
+        assert 0 <= filter <= 15, 'filter must be between 0 and 15'
+        if pull is None: # No pullup or pulldown resistor specified, use default.
+            if pin in default_pull['up']:
+                pull = pyb.Pin.PULL_UP
+            elif pin in default_pull['down']:
+                pull = pyb.Pin.PULL_DOWN
+            else:
+                pull = pyb.Pin.PULL_NONE
+        elif pull == 'up':
+            pull = pyb.Pin.PULL_UP
+        elif pull == 'down':
+            pull = pyb.Pin.PULL_DOWN
+        for af in pyb.Pin(pin).af_list(): # Find timer channel 1 or 2 connected to pin.
+            af_name = af.name().split('_') # e.g. 'AF2_TIM5_CH1'.
+            if (len(af_name) == 3 and af_name[1][:3] == 'TIM' and af_name[2] in ('CH1', 'CH2')
+                    and int(af_name[1][3:]) in available_timers):
+                self.timer_n = int(af_name[1][3:])
+                self.channel = int(af_name[2][2:])
+                break
+        else:
+            raise ValueError('Pin is not connected to channel 1 or 2 of an available timer.')
+        max_threshold = 0x100000000 if self.timer_n in (2, 5) else 0x10000 # TIM2 and TIM5 are 32 bit.
+        assert threshold is None or 1 <= threshold <= max_threshold, \
+            'threshold must be between 1 and {} for timer {}'.format(max_threshold, self.timer_n)
+        available_timers.remove(self.timer_n)
+        self.pin = pyb.Pin(pin, pyb.Pin.AF_PP, pull=pull, af=af.index())
+        self.timer = pyb.Timer(self.timer_n)
+        self.timer_base = getattr(stm, 'TIM{}'.format(self.timer_n)) # Timer register address.
+        self.event = event
+        self.threshold = threshold
+        self.falling = edge == 'falling'
+        self.filter = filter
+        self.n_periods = 0
+        self.period = 0x10000
+        assign_ID(self)
+
+    def _initialise(self):
+        # Set event code and counter period.
+        self.event_ID = fw.events[self.event] if self.event in fw.events else False
+        self.period = self.threshold if self.event_ID else 0x10000
+
+    def _run_start(self):
+        self.n_periods = 0
+        self.timer.init(prescaler=0, period=self.period-1)
+        self._set_external_clock()
+        self.timer.counter(0)
+        self.timer.callback(self._ISR)
+
+    def _run_stop(self):
+        self.timer.deinit()
+
+    def _set_external_clock(self):
+        # Configure timer to be clocked by edges on its input channel (external clock mode 1).
+        base = self.timer_base
+        shift = 0 if self.channel == 1 else 8
+        stm.mem16[base + stm.TIM_CCMR1] = (self.filter << (shift + 4)) | (1 << shift) # Input filter, CCxS = TIx.
+        stm.mem16[base + stm.TIM_CCER]  = self.falling << (1 + 4*(self.channel-1))    # Input polarity.
+        stm.mem16[base + stm.TIM_SMCR]  = ((5 if self.channel == 1 else 6) << 4) | 7  # Trigger TIxFPx, external clock mode 1.
+
+    def _ISR(self, t):
+        # Called when counter rolls over, every threshold edges if event specified.
+        self.n_periods += 1
+        if self.event_ID:
+            interrupt_queue.put(self.ID, fw.time_now(), fw.time_now_us() if fw.us_timestamps else -1, 0)
+
+    def _process_interrupt(self, timestamp, timestamp_us, data):
+        # Put event in event queue.
+        fw.event_queue.put(timestamp, fw.event_typ, self.event_ID, timestamp_us)
+
+    def count(self):
+        # Return number of edges counted since start of run.  If the counter has rolled
+        # over but the update interrupt has not yet been serviced, the timer's update
+        # flag is set and the counter is reread after the rollover.
+        irq_state = pyb.disable_irq()
+        counter = self.timer.counter()
+        if stm.mem16[self.timer_base + stm.TIM_SR] & 1: # Update interrupt pending.
+            counter = self.timer.counter() + self.period
+        n = self.n_periods * self.period + counter
+        pyb.enable_irq(irq_state)
+        return n
+
 # Analog input ----------------------------------------------------------------
 
 class Analog_input(IO_object):
@@ -245,12 +424,31 @@ class Analog_input(IO_object):
     # t timestamp of chunk start (ms)(4 bytes)
     # k checksum (2 bytes)
     # D data array bytes (variable)
+    # If decimation is set to an integer n, streamed data is decimated on the board by
+    # taking the mean (decimation_mode='mean') or the minimum and maximum 
+    # (decimation_mode='minmax') of each block of n samples, the sampling rate in the
+    # chunk header is the rate of the decimated data, with minmax data consisting of
+    # alternating minimum and maximum values.  Threshold crossings are detected 
+    # using the full rate data.  If compress is True chunks are sent as 'Z' frames, 
+    # which have the same header as 'A' frames but data bytes consisting of the zigzag
+    # encoded varint difference between each sample and the previous sample, if the
+    # compressed data is larger than the raw data the chunk is sent as an 'A' frame.
+    # If an Analog_sampler is passed as the sampler argument the input is sampled by the
+    # sampler's timer interrupt together with the sampler's other inputs, the double 
+    # buffers are filled continuously while acquiring, and threshold crossings are 
+    # detected in the main loop for each completed buffer rather than in the interrupt.
+    # Events generated by threshold crossings are then timestamped with the time of 
+    # the sample that crossed the threshold but are published up to one buffer 
+    # duration after the crossing.
 
     def __init__(self, pin, name, sampling_rate, threshold=None, rising_event=None, 
-                 falling_event=None, data_type='H'):
+                 falling_event=None, data_type='H', sampler=None, decimation=1,
+                 decimation_mode='mean', compress=False):
         if rising_event or falling_event:
             assert type(threshold) == int, 'Integer threshold must be specified if rising or falling events are defined.'
         assert data_type in ('b','B','h','H','l','L'), 'Invalid data_type.'
+        assert decimation_mode in ('mean', 'minmax'), 'Invalid decimation_mode.'
+        assert sampling_rate % decimation == 0, 'sampling_rate must be a multiple of decimation.'
         assert not any([name == io.name for io in IO_dict.values() 
                         if isinstance(io, Analog_input)]), 'Analog inputs must have unique names.'
         if pin: # pin argument can be None when Analog_input subclassed.
@@ -259,24 +457,39 @@ class Analog_input(IO_object):
         self.name = name
         assign_ID(self)
         # Data acqisition variables
-        self.timer = pyb.Timer(available_timers.pop())
+        self.sampler = sampler
+        if sampler: # Sampled by Analog_sampler timer.
+            sampler._add_input(self, sampling_rate)
+        else:
+            self.timer = pyb.Timer(available_timers.pop())
         self.recording = False # Whether data is being sent to computer.
         self.acquiring = False # Whether input is being monitored.
         self.sampling_rate = sampling_rate
         self.data_type = data_type
         self.bytes_per_sample = {'b':1,'B':1,'h':2,'H':2,'l':4,'L':4}[data_type]
         self.buffer_size = max(4, min(256 // self.bytes_per_sample, sampling_rate//10))
+        # Streaming variables
+        self.decimation = decimation
+        self.minmax = decimation_mode == 'minmax'
+        self.compress = compress
+        output_rate = sampling_rate
+        if decimation > 1: # Make buffer size a multiple of decimation.
+            self.buffer_size = max(1, self.buffer_size // decimation) * decimation
+            n_blocks = self.buffer_size // decimation
+            self.output_buffer = array(data_type, [0] * (2*n_blocks if self.minmax else n_blocks))
+            output_rate = (2*sampling_rate if self.minmax else sampling_rate) // decimation
+        if compress: # Varints of 32 bit differences are at most 5 bytes.
+            self.compress_buffer = bytearray(5 * self.buffer_size)
         self.buffers = (array(data_type, [0]*self.buffer_size),array(data_type, [0]*self.buffer_size))
         self.buffers_mv = (memoryview(self.buffers[0]), memoryview(self.buffers[1]))
         self.buffer_start_times = array('i', [0,0])
         self.data_header = array('B', b'A' + data_type.encode() + 
-            self.ID.to_bytes(2,'little') + sampling_rate.to_bytes(2,'little') + b'\x00'*8)
+            self.ID.to_bytes(2,'little') + output_rate.to_bytes(2,'little') + b'\x00'*8)
+        self.header_checksum = sum(self.data_header[1:6]) # Checksum of constant header bytes.
         # Event generation variables
         self.threshold = threshold
         self.rising_event = rising_event
         self.falling_event = falling_event
-        self.timestamp = 0
-        self.crossing_direction = False
 
     def _initialise(self):
         # Set event codes for rising and falling events.
@@ -298,17 +511,23 @@ class Analog_input(IO_object):
 
     def _start_acquisition(self):
         # Start sampling analog input values.
-        self.timer.init(freq=self.sampling_rate)
-        self.timer.callback(self._timer_ISR)
         if self.threshold_active:
             self.above_threshold = self.read_sample() > self.threshold
         self.acquiring = True
+        if self.sampler:
+            self.write_index = 0
+            self.buffer_start_times[self.write_buffer] = fw.current_time
+            self.sampler._start()
+        else:
+            self.timer.init(freq=self.sampling_rate)
+            self.timer.callback(self._timer_ISR)
 
     def record(self):
         # Start streaming data to computer.
         if not self.recording:
-            self.write_index = 0  # Buffer index to write new data to. 
-            self.buffer_start_times[self.write_buffer] = fw.current_time
+            if not (self.sampler and self.acquiring): # Buffers not already being filled.
+                self.write_index = 0  # Buffer index to write new data to. 
+                self.buffer_start_times[self.write_buffer] = fw.current_time
             self.recording = True
             if not self.acquiring: self._start_acquisition()
 
@@ -323,8 +542,11 @@ class Analog_input(IO_object):
 
     def _stop_acquisition(self):
         # Stop sampling analog input values.
-        self.timer.deinit()
         self.acquiring = False
+        if self.sampler:
+            self.sampler._stop()
+        else:
+            self.timer.deinit()
 
     def _timer_ISR(self, t):
         # Read a sample to the buffer, update write index.
@@ -335,44 +557,172 @@ class Analog_input(IO_object):
                 self.above_threshold = new_above_threshold
                 if ((    self.above_threshold and self.rising_event_ID) or 
                     (not self.above_threshold and self.falling_event_ID)):
-                        self.timestamp = fw.current_time
-                        self.crossing_direction = self.above_threshold
-                        interrupt_queue.put(self.ID)
+                        interrupt_queue.put(self.ID, fw.time_now(), 
+                            fw.time_now_us() if fw.us_timestamps else -1, self.above_threshold)
         if self.recording:
             self.write_index = (self.write_index + 1) % self.buffer_size
             if self.write_index == 0: # Buffer full, switch buffers.
                 self.write_buffer = 1 - self.write_buffer
-                self.buffer_start_times[self.write_buffer] = fw.current_time
+                self.buffer_start_times[self.write_buffer] = fw.time_now()
                 stream_data_queue.put(self.ID)
 
-    def _process_interrupt(self):
+    def _sampler_ISR(self):
+        # Called by Analog_sampler timer interrupt, read a sample to the buffer and
+        # switch buffers when full.
+        self.buffers[self.write_buffer][self.write_index] = self.read_sample()
+        self.write_index = (self.write_index + 1) % self.buffer_size
+        if self.write_index == 0: # Buffer full, switch buffers.
+            self.write_buffer = 1 - self.write_buffer
+            self.buffer_start_times[self.write_buffer] = fw.time_now()
+            stream_data_queue.put(self.ID)
+
+    @micropython.native
+    def _check_threshold(self, buffer_n):
+        # Put events for threshold crossings in completed buffer in event queue, 
+        # timestamped with the time of the sample that crossed the threshold.
+        buffer = self.buffers[buffer_n]
+        for i in range(self.buffer_size):
+            above_threshold = buffer[i] > self.threshold
+            if above_threshold != self.above_threshold: # Threshold crossing.
+                self.above_threshold = above_threshold
+                if ((    above_threshold and self.rising_event_ID) or 
+                    (not above_threshold and self.falling_event_ID)):
+                    timestamp = self.buffer_start_times[buffer_n] + (1000*i) // self.sampling_rate
+                    self._process_interrupt(timestamp, -1, above_threshold)
+
+    def _process_interrupt(self, timestamp, timestamp_us, above_threshold):
         # Put event generated by threshold crossing in event queue.
-        if self.crossing_direction:
-            fw.event_queue.put((self.timestamp, fw.event_typ, self.rising_event_ID))
+        if above_threshold:
+            fw.event_queue.put(timestamp, fw.event_typ, self.rising_event_ID, timestamp_us)
         else:
-            fw.event_queue.put((self.timestamp, fw.event_typ, self.falling_event_ID))
+            fw.event_queue.put(timestamp, fw.event_typ, self.falling_event_ID, timestamp_us)
 
     def _process_streaming(self):
-        # Stream full buffer to computer.
+        # Stream full buffer to computer, if using sampler check buffer for threshold crossings.
+        if self.sampler:
+            if self.threshold_active:
+                self._check_threshold(1-self.write_buffer)
+            if not self.recording:
+                return
         self._send_buffer(1-self.write_buffer)
 
     def _send_buffer(self, buffer_n, n_samples=False):
-        # Send specified buffer to host computer.
-        n_bytes = self.bytes_per_sample*n_samples if n_samples else self.bytes_per_sample*self.buffer_size
-        self.data_header[6:8]  = n_bytes.to_bytes(2,'little')
-        self.data_header[8:12] = self.buffer_start_times[buffer_n].to_bytes(4,'little')
-        checksum = sum(self.buffers_mv[buffer_n][:n_samples] if n_samples else self.buffers[buffer_n])
-        checksum += sum(self.data_header[1:12])
-        self.data_header[12:14] = checksum.to_bytes(2,'little')
+        # Send specified buffer to host computer, decimated and compressed if specified.
+        data = self.buffers[buffer_n]
+        if not n_samples:
+            n_samples = self.buffer_size
+        if self.decimation > 1:
+            n_samples = self._decimate(data, n_samples)
+            data = self.output_buffer
+            if not n_samples:
+                return # No complete blocks to send.
+        if n_samples < len(data): # Send first n_samples from data.
+            data = memoryview(data)[:n_samples]
+        if self.compress:
+            n_bytes = self._compress(data, n_samples)
+            if n_bytes < self.bytes_per_sample*n_samples: # Send compressed chunk.
+                data = memoryview(self.compress_buffer)[:n_bytes]
+                self.data_header[0] = 90 # 'Z'
+                self._send_chunk(buffer_n, data, n_bytes, sum(data))
+                return
+        self.data_header[0] = 65 # 'A'
+        self._send_chunk(buffer_n, data, self.bytes_per_sample*n_samples, sum(data))
+
+    def _send_chunk(self, buffer_n, data, n_bytes, data_sum):
+        # Send data header and data for chunk starting at buffer_n start time.
+        checksum  = data_sum + self.header_checksum
+        checksum += fw.write_int(self.data_header, 6, n_bytes, 2)
+        checksum += fw.write_int(self.data_header, 8, self.buffer_start_times[buffer_n], 4)
+        fw.write_int(self.data_header, 12, checksum, 2)
         fw.usb_serial.write(self.data_header)
-        if n_samples: # Send first n_samples from buffer.
-            fw.usb_serial.send(self.buffers_mv[buffer_n][:n_samples])
-        else: # Send entire buffer.
-            fw.usb_serial.send(self.buffers[buffer_n])
+        fw.usb_serial.send(data)
+
+    @micropython.native
+    def _decimate(self, data, n_samples):
+        # Write mean, or minimum and maximum, of each complete block of decimation 
+        # samples in first n_samples of data to output_buffer, return number of values written.
+        n = self.decimation
+        j = 0
+        for block_start in range(0, n_samples - n + 1, n):
+            if self.minmax:
+                low = high = data[block_start]
+                for i in range(block_start + 1, block_start + n):
+                    if data[i] < low:
+                        low = data[i]
+                    elif data[i] > high:
+                        high = data[i]
+                self.output_buffer[j] = low
+                self.output_buffer[j+1] = high
+                j += 2
+            else:
+                total = 0
+                for i in range(block_start, block_start + n):
+                    total += data[i]
+                self.output_buffer[j] = total // n
+                j += 1
+        return j
+
+    @micropython.native
+    def _compress(self, data, n_samples):
+        # Write difference between each sample and previous sample in first n_samples of 
+        # data to compress_buffer as zigzag varints, return number of bytes written.
+        i = 0
+        previous = 0
+        for k in range(n_samples):
+            i = fw.put_varint(self.compress_buffer, i, data[k] - previous)
+            previous = data[k]
+        return i
+
+# Analog sampler --------------------------------------------------------------
+
+class Analog_sampler():
+    # Samples a group of Analog_inputs at the same sampling rate from a single hardware
+    # timer interrupt, which reads one sample from each acquiring input into its double
+    # buffers.  Using one timer for many inputs reduces interrupt overheads and the 
+    # number of hardware timers used.  Inputs are added by passing the sampler as the 
+    # sampler argument when the Analog_input is instantiated, e.g:
+    # sampler = Analog_sampler(sampling_rate=1000)
+    # photometry_1 = Analog_input('X11', 'photo_1', 1000, sampler=sampler)
+    # photometry_2 = Analog_input('X12', 'photo_2', 1000, sampler=sampler)
+
+    def __init__(self, sampling_rate):
+        self.sampling_rate = sampling_rate
+        self.timer = pyb.Timer(available_timers.pop())
+        self.inputs = [] # Analog inputs sampled by sampler.
+        self.running = False
+
+    def _add_input(self, analog_input, sampling_rate):
+        assert sampling_rate == self.sampling_rate, 'Analog_input sampling_rate must match Analog_sampler.'
+        self.inputs.append(analog_input)
+
+    def _start(self):
+        # Start timer if not already running.
+        if not self.running:
+            self.timer.init(freq=self.sampling_rate)
+            self.timer.callback(self._timer_ISR)
+            self.running = True
+
+    def _stop(self):
+        # Stop timer if no inputs are acquiring.
+        if self.running and not any([analog_input.acquiring for analog_input in self.inputs]):
+            self.timer.deinit()
+            self.running = False
+
+    def _timer_ISR(self, t):
+        # Read a sample from each acquiring input.
+        for analog_input in self.inputs:
+            if analog_input.acquiring:
+                analog_input._sampler_ISR()
 
 # Digital Output --------------------------------------------------------------
 
 class Digital_output(IO_object):
+    # Digital output which can generate pulse trains if pulse_enabled is True. If the pin
+    # is a pyboard pin connected to a timer channel whose timer is available, pulses are 
+    # generated by the timer in PWM mode, which supports any duty cycle and uses no CPU 
+    # time per edge, with the timer callback used only to count pulses if n_pulses is 
+    # specified.  Otherwise pulses are generated by toggling the pin from a timer 
+    # callback, which supports duty cycles of 10, 25, 50 and 75%.
 
     def __init__(self, pin, inverted=False, pulse_enabled=False):
         if isinstance(pin, IO_expander_pin):
@@ -382,22 +732,30 @@ class Digital_output(IO_object):
             self.pin = pyb.Pin(pin, pyb.Pin.OUT)  # Pin is pyboard pin.
         self.inverted = inverted # Set True for inverted output.
         self.timer = False # Replaced by timer object if pulse enabled.
+        self.PWM_channel = None # Timer channel number if pulses generated by PWM.
+        self.PWM_active = False # True while timer is generating PWM on pin.
         self.off()
         assign_ID(self)
         if pulse_enabled:
             self.enable_pulse()
 
     def on(self):
+        if self.PWM_active:
+            self._stop_PWM()
         self.pin.value(not self.inverted)
         self.state = True
 
     def off(self):
         if self.timer:
             self.timer.deinit()
+        if self.PWM_active:
+            self._stop_PWM()
         self.pin.value(self.inverted)
         self.state = False
 
     def toggle(self):
+        if self.PWM_active:
+            self._stop_PWM()
         if self.state:
             self.pin.value(self.inverted)
         else:
@@ -405,11 +763,24 @@ class Digital_output(IO_object):
         self.state = not self.state  
 
     def enable_pulse(self): # Setup a hardware timer to allow pulsed output  
+        if not isinstance(self.pin, IO_expander_pin): # Find timer channel for PWM.
+            for af in self.pin.af_list():
+                af_name = af.name().split('_') # e.g. 'AF2_TIM5_CH1'.
+                if (len(af_name) == 3 and af_name[1][:3] == 'TIM' and af_name[2][:2] == 'CH' and
+                        af_name[2][2:].isdigit() and int(af_name[1][3:]) in available_timers):
+                    self.timer_n = int(af_name[1][3:])
+                    available_timers.remove(self.timer_n)
+                    self.timer = pyb.Timer(self.timer_n)
+                    self.PWM_channel = int(af_name[2][2:])
+                    return
         self.timer = pyb.Timer(available_timers.pop())
         self.freq_multipliers = {10:10, 25:4, 50:2, 75:4}
         self.off_inds = {10:1, 25:1, 50:1, 75:3}
 
     def pulse(self, freq, duty_cycle=50, n_pulses=False): # Turn on pulsed output with specified frequency and duty cycle.
+        if self.PWM_channel:
+            self._PWM_pulse(freq, duty_cycle, n_pulses)
+            return
         assert duty_cycle in (10,25,50,75), 'duty_cycle must be 10, 25, 50 or 75'
         self.off_ind = self.off_inds[duty_cycle]
         self.i = 0
@@ -434,6 +805,37 @@ class Digital_output(IO_object):
         elif self.i == self.off_ind:
             self.toggle()
 
+    def _PWM_pulse(self, freq, duty_cycle, n_pulses):
+        # Generate pulses with timer in PWM mode, if n_pulses is specified the timer 
+        # callback counts pulses.  Compare values are preloaded so setting the pulse 
+        # width to 0 takes effect at the end of the current pulse.
+        assert 0 < duty_cycle < 100, 'duty_cycle must be between 0 and 100'
+        self.n_pulses = n_pulses
+        self.pulse_n = 0
+        self.timer.init(freq=freq)
+        self.PWM = self.timer.channel(self.PWM_channel, pyb.Timer.PWM_INVERTED if self.inverted 
+                                      else pyb.Timer.PWM, pin=self.pin, pulse_width_percent=duty_cycle)
+        self.PWM_active = True
+        self.state = True
+        if n_pulses:
+            if n_pulses == 1:
+                self.PWM.pulse_width(0)
+            self.timer.callback(self._PWM_ISR)
+
+    def _PWM_ISR(self, t):
+        # Called at the end of each pulse, turn off output after n_pulses.
+        self.pulse_n += 1
+        if self.pulse_n == self.n_pulses - 1: # Last pulse started.
+            self.PWM.pulse_width(0)
+        elif self.pulse_n == self.n_pulses:
+            self.off()
+
+    def _stop_PWM(self):
+        # Stop timer and return pin to output mode.
+        self.timer.deinit()
+        self.pin.init(pyb.Pin.OUT)
+        self.PWM_active = False
+
 # Port ------------------------------------------------------------------------
 
 class Port():
@@ -464,18 +866,145 @@ class IO_expander_pin():
     # Parent class for IO expander pins.
     pass
 
+# UART line device ------------------------------------------------------------
+
+class UART_line_device(IO_object):
+    # Parent class for devices which send newline terminated messages over a UART. Bytes
+    # received by the UART are buffered by the UART driver and the UART receive idle
+    # interrupt queues the device for processing, each complete line is then stored 
+    # and, if line_event is specified, an event is published.  Lines are returned in 
+    # the order they were received by read_line(), so a task can react to messages 
+    # from the device in the handler for line_event without polling the UART.  If 
+    # more than max_lines lines are stored the oldest line is discarded.
+    # Messages sent with write() while the framework is running are copied to a 
+    # preallocated transmit buffer and sent from the main loop, which writes as many
+    # bytes as the UART accepts in tx_time_us per call, so writing does not block
+    # for the whole transmission time. If the transmit buffer is full, or the
+    # framework is not running, messages are written immediately.
+
+    def __init__(self, uart, line_event=None, max_line_length=128, max_lines=8, 
+                 tx_buffer_length=128, tx_time_us=500):
+        self.uart = uart
+        self.line_event = line_event
+        self.rx_buffer = bytearray(max_line_length) # Buffer for partially received line.
+        self.n_received = 0 # Number of bytes of partially received line.
+        self.max_lines = max_lines
+        self.lines = [] # Complete lines not yet read.
+        self.tx_buffer = bytearray(tx_buffer_length) # Ring buffer of bytes to transmit.
+        self.tx_time_us = tx_time_us # Time spent writing queued bytes per main loop call (us).
+        self._reset_tx()
+        assign_ID(self)
+
+    def _initialise(self):
+        self.line_event_ID = fw.events[self.line_event] if self.line_event in fw.events else False
+        self.uart.irq(handler=self._ISR, trigger=self.uart.IRQ_RXIDLE)
+
+    def _run_start(self):
+        self.n_received = 0
+        self.lines = []
+        while self.uart.any(): # Discard bytes received before run started.
+            self.uart.read()
+        self._flush()
+        self._reset_tx()
+
+    def _run_stop(self):
+        self._flush()
+
+    def _reset_tx(self):
+        self.tx_read  = 0 # Index of next byte to transmit.
+        self.tx_write = 0 # Index to write next queued byte.
+        self.tx_n = 0 # Number of bytes waiting to be transmitted.
+        self.tx_queued = False # Whether ID is in uart_tx_queue.
+
+    def _ISR(self, uart):
+        interrupt_queue.put(self.ID, fw.time_now(), -1, 0)
+
+    def _process_interrupt(self, timestamp, timestamp_us, data):
+        # Read received bytes, store complete lines and publish event for each line.
+        while self.uart.any():
+            byte = self.uart.readchar()
+            if byte == 10: # '\n', line complete.
+                line = bytes(self.rx_buffer[:self.n_received]).decode().strip('\r')
+                self.n_received = 0
+                if len(self.lines) == self.max_lines:
+                    self.lines.pop(0)
+                self.lines.append(line)
+                if self.line_event_ID:
+                    fw.event_queue.put(timestamp, fw.event_typ, self.line_event_ID)
+            elif self.n_received < len(self.rx_buffer):
+                self.rx_buffer[self.n_received] = byte
+                self.n_received += 1
+
+    def read_line(self):
+        # Return oldest unread line received from device, None if no lines are available.
+        if self.lines:
+            return self.lines.pop(0)
+        return None
+
+    def write(self, message):
+        # Queue message (str or bytes) to be transmitted from main loop.
+        if isinstance(message, str):
+            message = message.encode()
+        if not fw.running or len(message) > len(self.tx_buffer) - self.tx_n:
+            self._flush() # Write queued bytes and message immediately.
+            self.uart.write(message)
+            return
+        for byte in message:
+            self.tx_buffer[self.tx_write] = byte
+            self.tx_write = (self.tx_write + 1) % len(self.tx_buffer)
+        self.tx_n += len(message)
+        if not self.tx_queued:
+            self.tx_queued = True
+            uart_tx_queue.put(self.ID)
+
+    def _process_tx(self):
+        # Called from main loop, write queued bytes until tx_time_us has elapsed.  Each 
+        # writechar waits only until the UART can accept the byte, so bytes are written
+        # as fast as the UART transmits them.
+        start = pyb.micros()
+        while self.tx_n and pyb.elapsed_micros(start) < self.tx_time_us:
+            self.uart.writechar(self.tx_buffer[self.tx_read])
+            self.tx_read = (self.tx_read + 1) % len(self.tx_buffer)
+            self.tx_n -= 1
+        if self.tx_n:
+            uart_tx_queue.put(self.ID)
+        else:
+            self.tx_queued = False
+
+    def _flush(self):
+        # Write all queued bytes, blocking until written.
+        while self.tx_n:
+            self.uart.writechar(self.tx_buffer[self.tx_read])
+            self.tx_read = (self.tx_read + 1) % len(self.tx_buffer)
+            self.tx_n -= 1
+
 # Rsync -----------------------------------------------------------------------
 
 class Rsync(IO_object):
-    # Class for generating sync pulses with random inter-pulse interval.
-
-    def __init__(self, pin, event_name='rsync', mean_IPI=5000, pulse_dur=50):
+    # Class for generating sync pulses with random inter-pulse interval. If a 
+    # hardware timer number is specified the pin is driven from the timer interrupt
+    # using a precomputed random schedule of inter-pulse intervals, so pulse edges 
+    # do not depend on main loop latency and the logged pulse times are the times
+    # the pin went high (with microsecond timestamp if enabled).  The timer period
+    # is reprogrammed at each pin change so there is one interrupt per edge. 
+    # Otherwise pulses are generated using the framework timer.
+
+    def __init__(self, pin, event_name='rsync', mean_IPI=5000, pulse_dur=50, 
+                 timer=None, schedule_length=8):
         assert 0.1*mean_IPI > pulse_dur, '0.1*mean_IPI must be greater than pulse_dur'
         self.sync_pin = pyb.Pin(pin, pyb.Pin.OUT)
         self.event_name = event_name
         self.pulse_dur = pulse_dur       # Sync pulse duration (ms)
         self.min_IPI = int(0.1*mean_IPI) 
         self.max_IPI = int(1.9*mean_IPI)
+        self.timer = None
+        if timer:
+            assert timer in available_timers, 'Timer {} is not available.'.format(timer)
+            available_timers.remove(timer)
+            self.timer_n = timer
+            self.timer = pyb.Timer(timer)
+            self.max_period = 0x40000000 if timer in (2, 5) else 0x10000 # Max timer period (ticks), TIM2 and TIM5 are 32 bit.
+            self.IPIs = array('i', [0] * schedule_length) # Schedule of inter-pulse intervals (ms).
         assign_ID(self)
 
     def _initialise(self):
@@ -484,16 +1013,57 @@ class Rsync(IO_object):
     def _run_start(self): 
         if self.event_ID:
             self.state = False # Whether output is high or low.
-            self._timer_callback()
+            if self.timer:
+                for i in range(len(self.IPIs)):
+                    self.IPIs[i] = randint(self.min_IPI, self.max_IPI)
+                self.schedule_ind = 0 # Index of next IPI to use.
+                self.refill_ind = -1  # Index of next IPI to replace, -1 before first IPI used.
+                self.remaining = 0    # Ticks left in interval after current timer period.
+                self.timer.init(prescaler=self.timer.source_freq()//10000-1, period=9) # 0.1ms ticks, first pulse after 1ms.
+                base = getattr(stm, 'TIM{}'.format(self.timer_n))
+                stm.mem16[base + stm.TIM_CR1] &= ~0x80 # Disable auto-reload preload so new periods apply immediately.
+                self.timer.callback(self._ISR)
+            else:
+                self._timer_callback()
 
     def _run_stop(self):
+        if self.timer:
+            self.timer.deinit()
         self.sync_pin.value(False)
 
+    def _ISR(self, t):
+        # Called by hardware timer at scheduled pin changes.
+        if self.remaining: # Interval is longer than max timer period, keep counting.
+            self._set_period(self.remaining)
+            return
+        self.state = not self.state
+        self.sync_pin.value(self.state)
+        if self.state: # Pin low -> high, log pulse time.
+            self._set_period(10*self.pulse_dur)
+            interrupt_queue.put(self.ID, fw.time_now(), fw.time_now_us() if fw.us_timestamps else -1, 0)
+        else: # Pin high -> low, wait next scheduled IPI.
+            self._set_period(10*self.IPIs[self.schedule_ind])
+            self.schedule_ind = (self.schedule_ind + 1) % len(self.IPIs)
+
+    def _set_period(self, ticks):
+        # Set timer to interrupt after ticks (0.1ms), over several periods if ticks 
+        # is longer than the maximum timer period.
+        period = min(ticks, self.max_period)
+        self.remaining = ticks - period
+        self.timer.period(period-1)
+
+    def _process_interrupt(self, timestamp, timestamp_us, data):
+        # Output pulse time and replace the IPI used before this pulse in the schedule.
+        fw.data_output_queue.put(timestamp, fw.event_typ, self.event_ID, timestamp_us)
+        if self.refill_ind >= 0:
+            self.IPIs[self.refill_ind] = randint(self.min_IPI, self.max_IPI)
+        self.refill_ind = (self.refill_ind + 1) % len(self.IPIs)
+
     def _timer_callback(self):
         if self.state: # Pin high -> low, set timer for next pulse.
             fw.timer.set(randint(self.min_IPI, self.max_IPI), fw.hardw_typ, self.ID)
         else: # Pin low -> high, set timer for pulse duration.
             fw.timer.set(self.pulse_dur, fw.hardw_typ, self.ID)
-            fw.data_output_queue.put((fw.current_time, fw.event_typ, self.event_ID))
+            fw.data_output_queue.put(fw.current_time, fw.event_typ, self.event_ID)
         self.state = not self.state
         self.sync_pin.value(self.state)
\ No newline at end of file
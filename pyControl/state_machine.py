@@ -4,6 +4,11 @@ class State_machine():
     # State machine behaviour is defined by passing state machine description object smd to 
     # State_machine __init__(). smd is a module which defines the states, events and  
     # functionality of the state machine object that is created (see examples). 
+    # In addition to state event handler functions which are passed the event name, smd can
+    # bind functions to specific events in specific states with a dict:
+    # handlers = {state_name: {event_name: function}}, or by calling bind_handler(). Bound
+    # functions are called with no arguments and are looked up in per state dispatch tables
+    # keyed by event ID, so do not require event names to be compared.
 
     def __init__(self, smd):
 
@@ -21,6 +26,16 @@ class State_machine():
             else:
                 self.event_dispatch_dict[state] = None
 
+        # Make dispatch tables {state_name: {event_ID: handler}} for bound handlers, 
+        # entry and exit handlers are keyed by 'entry' and 'exit'.
+        self.dispatch_tables = {state: {} for state in list(self.smd.states) + ['all_states']}
+        self.all_states_table = self.dispatch_tables['all_states']
+        self.current_table = {}
+        if hasattr(self.smd, 'handlers'):
+            for state, state_handlers in self.smd.handlers.items():
+                for event, handler in state_handlers.items():
+                    self.bind_handler(state, event, handler)
+
         # Attach user methods to discription object namespace, this allows the user
         # to write e.g. goto_state(state) in the task description to call 
         # State_machine.goto_state. 
@@ -37,6 +52,7 @@ class State_machine():
         smd.publish_event    = self.publish_event
         smd.get_current_time = self.get_current_time
         smd.timer_remaining  = self.timer_remaining
+        smd.bind_handler     = self.bind_handler
 
     # Methods called by user
 
@@ -45,14 +61,15 @@ class State_machine():
         # and entry action of next state.
         if self.state_transition_in_progress:
             raise fw.pyControlError("goto_state cannot not be called while processing 'entry' or 'exit' events.")
-        if not next_state in self.smd.states.keys():
+        if not next_state in self.smd.states:
             raise fw.pyControlError('Invalid state name passed to goto_state: ' + repr(next_state))
         self.state_transition_in_progress = True
         self._process_event('exit')
         fw.timer.disarm_type(fw.state_typ) # Clear any timed_goto_states     
         if fw.data_output:
-            fw.data_output_queue.put((fw.current_time, fw.state_typ, fw.states[next_state]))
+            fw.data_output_queue.put(fw.current_time, fw.state_typ, fw.states[next_state])
         self.current_state = next_state
+        self.current_table = self.dispatch_tables[next_state]
         self._process_event('entry')
         self.state_transition_in_progress = False
 
@@ -93,11 +110,23 @@ class State_machine():
         # Used to output data print_string with timestamp.  print_string is stored and only
         #  printed to serial line once higher priority tasks have all been processed. 
         if fw.data_output:
-            fw.data_output_queue.put((fw.current_time, fw.print_typ, str(print_string)))
+            fw.data_output_queue.put(fw.current_time, fw.print_typ, str(print_string))
 
     def publish_event(self, event):
         # Put event with specified name in the event queue.
-        fw.event_queue.put((fw.current_time, fw.event_typ, fw.events[event]))
+        fw.event_queue.put(fw.current_time, fw.event_typ, fw.events[event])
+
+    def bind_handler(self, state, event, handler):
+        # Bind function handler to be called with no arguments when specified event occurs
+        # in specified state. State can be 'all_states', event can be 'entry' or 'exit'.
+        if not state in self.dispatch_tables:
+            raise fw.pyControlError('Invalid state name passed to bind_handler: ' + repr(state))
+        if event in ('entry', 'exit'):
+            self.dispatch_tables[state][event] = handler
+        elif event in fw.events:
+            self.dispatch_tables[state][fw.events[event]] = handler
+        else:
+            raise fw.pyControlError('Invalid event name passed to bind_handler: ' + repr(event))
 
     def stop_framework(self):
         fw.running = False
@@ -109,19 +138,38 @@ class State_machine():
 
     def _process_event(self, event):
         # Process event given event name by calling appropriate state event handler function.
-        if self.event_dispatch_dict['all_states']:                      # If machine has all_states event handler function. 
+        if event in self.all_states_table:                              # If handler bound to event in all_states.
+            if self.all_states_table[event](): return                   # If bound handler returns True, don't evaluate state specific behaviour.
+        elif self.event_dispatch_dict['all_states']:                    # If machine has all_states event handler function. 
             handled = self.event_dispatch_dict['all_states'](event)     # Evaluate all_states event handler function.
             if handled: return                                          # If all_states event handler returns True, don't evaluate state specific behaviour.
-        if self.event_dispatch_dict[self.current_state]:                # If state machine has event handler function for current state.
+        if event in self.current_table:                                 # If handler bound to event in current state.
+            self.current_table[event]()                                 # Evaluate bound handler.
+        elif self.event_dispatch_dict[self.current_state]:              # If state machine has event handler function for current state.
             self.event_dispatch_dict[self.current_state](event)         # Evaluate state event handler function.
 
+    def _process_event_ID(self, event_ID):
+        # Process event given event ID, bound handlers are looked up by ID, the event name
+        # is only looked up if it is passed to a state event handler function.
+        handler = self.all_states_table.get(event_ID)
+        if handler:
+            if handler(): return
+        elif self.event_dispatch_dict['all_states']:
+            if self.event_dispatch_dict['all_states'](fw.ID2name[event_ID]): return
+        handler = self.current_table.get(event_ID)
+        if handler:
+            handler()
+        elif self.event_dispatch_dict[self.current_state]:
+            self.event_dispatch_dict[self.current_state](fw.ID2name[event_ID])
+
     def _start(self):
         # Called when run is started. Puts agent in initial state, and runs entry event.
         if self.event_dispatch_dict['run_start']:
             self.event_dispatch_dict['run_start']()
         self.current_state = self.smd.initial_state
+        self.current_table = self.dispatch_tables[self.current_state]
         if fw.data_output:
-            fw.data_output_queue.put((fw.current_time, fw.state_typ, fw.states[self.current_state]))
+            fw.data_output_queue.put(fw.current_time, fw.state_typ, fw.states[self.current_state])
         self._process_event('entry')
 
     def _stop(self):
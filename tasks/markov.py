@@ -23,6 +23,7 @@ events = [
     'tone_off',
     'check_serial',
     'Sync_pulse',
+    'Frame_checkpoint',
     ]
 
 ####### Hidden script variables ##########
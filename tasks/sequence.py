@@ -11,9 +11,12 @@ states= [
 
 events = [
     'Sync_pulse',
+    'Frame_checkpoint',
     'blink_timer',
     'side_delay_timer',
-    'check_serial',
+    'base_station_message',
+    'R_pump_message',
+    'L_pump_message',
     'held_long_enough',
     'forgive_window_closed',
     'faultiness_expired',
@@ -94,7 +97,6 @@ def run_start():
     hw.Speakers.set_volume(30)
     updateHold()
     updateSide()
-    set_timer('check_serial',10)
     hw.Camera.frame_grab_trigger.pulse(50) # trigger frame grab at 50Hz for 50fps video
     hw.Camera.light.on()
 
@@ -232,17 +234,14 @@ F: faulty nosepoke
 """
 
 def all_states(event):
-    if event == 'check_serial':
-        set_timer('check_serial',10)
-        msg = hw.BaseStation.check_for_serial()
-        if msg:
-            print(msg)
-    Lmsg = hw.Lpump.check_for_serial()
-    if Lmsg:
+    if event == 'base_station_message':
+        print(hw.BaseStation.read_line())
+    elif event == 'L_pump_message':
+        hw.Lpump.read_line()
         print("Stoping task. Left pump empty")
         stop_framework()
-    Rmsg = hw.Rpump.check_for_serial()
-    if Rmsg:
+    elif event == 'R_pump_message':
+        hw.Rpump.read_line()
         print("Stopping task. Right pump empty")
         stop_framework()
 
@@ -0,0 +1,92 @@
+# Benchmark for decoding data sent by the pyboard with Pycboard.process_data. A
+# byte stream of data frames is passed to process_data through a dummy serial port
+# which returns at most chunk_size bytes per read, so frames are split across reads
+# as they are when data arrives from the board.  The decoding throughput is printed
+# in MB/s and frames/s, with the number of calls to the serial port per frame as 
+# each call to a real serial port has a fixed overhead, and the decoded data is 
+# checked against decoding the whole stream in one read.  By default a stream representative of a task with events,
+# prints and an analog input is generated, alternatively the path of a file of 
+# bytes recorded from the serial port while the framework was running can be given
+# as an argument.  Run from the pyControl folder with:
+# python "tests/Computer tests/process_data_benchmark.py" [stream_file_path]
+
+import os
+import sys
+import time
+import struct
+import random
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from com.pycboard import Pycboard
+
+chunk_size = 1000 # Maximum bytes returned per serial read.
+n_repeats = 5 # Number of times the stream is decoded.
+
+class Dummy_serial():
+    '''Serial port returning bytes from stream in reads of at most chunk_size bytes.'''
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.i = 0
+        self.n_calls = 0
+
+    def inWaiting(self):
+        self.n_calls += 1
+        return min(len(self.stream) - self.i, self.chunk_size)
+
+    def read(self, n):
+        self.n_calls += 1
+        data = self.stream[self.i:self.i+n]
+        self.i += len(data)
+        return data
+
+def string_frame(frame_type, timestamp, data_bytes):
+    header = struct.pack('<HI', len(data_bytes), timestamp)
+    return frame_type + header + struct.pack('<H', (sum(header) + sum(data_bytes)) & 0xffff) + data_bytes
+
+def generate_stream(duration=60000):
+    '''Return bytes of data frames for a session of duration ms with an event or 
+    state change every 10ms, a print every second and an analog input sampled at 
+    1kHz sent in chunks of 100 samples.'''
+    frames = []
+    for t in range(duration):
+        if t % 10 == 0: # Event or state change.
+            header = struct.pack('<IH', t, random.randint(1, 20))
+            frames.append(b'D' + header + struct.pack('<H', sum(header)))
+        if t % 1000 == 0: # Print.
+            frames.append(string_frame(b'P', t, 'trial {} outcome {}'.format(t//1000, 1).encode()))
+        if t % 100 == 99: # Analog chunk.
+            data = array('H', [random.randint(0, 4095) for i in range(100)])
+            header = struct.pack('<cHHHI', b'H', 21, 1000, 200, t - 99)
+            frames.append(b'A' + header + struct.pack('<H', (sum(header) + sum(data)) & 0xffff) + data.tobytes())
+    return b''.join(frames)
+
+def decode(stream, chunk_size):
+    '''Return list of data tuples decoded from stream, time taken to decode and
+    number of calls to serial port.'''
+    board = Pycboard.__new__(Pycboard) # Pycboard without connection to a board.
+    board.serial = Dummy_serial(stream, chunk_size)
+    board.read_buffer = bytearray()
+    board.reader = None
+    board.sm_info = {'variables': {}}
+    decoded = []
+    board.data_logger = type('Logger', (), {'process_data': lambda self, new_data: decoded.extend(new_data)})()
+    start = time.perf_counter()
+    while board.serial.inWaiting():
+        board.process_data()
+    return decoded, time.perf_counter() - start, board.serial.n_calls
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            stream = f.read()
+    else:
+        stream = generate_stream()
+    reference, _, _ = decode(stream, len(stream))
+    for i in range(n_repeats):
+        decoded, dur, n_calls = decode(stream, chunk_size)
+        assert [str(d) for d in decoded] == [str(r) for r in reference], 'Decoded data does not match.'
+        print('{:.1f} MB/s, {:.0f} frames/s, {:.2f} serial calls/frame'.format(
+              len(stream)/dur/1e6, len(decoded)/dur, n_calls/len(decoded)))
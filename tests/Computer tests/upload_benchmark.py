@@ -0,0 +1,84 @@
+# Benchmark for uploading the pyControl framework to a pyboard.  The files in the
+# pyControl and devices folders are uploaded with the previous file transfer path,
+# which sends each file in its own raw REPL session as 512 byte chunks each
+# acknowledged with 'OK' before the next is sent, and checks the file hash before
+# and after each file, and with the current path, which checks the hashes of all
+# files in one call and sends all files in a single raw REPL session with windowed
+# acknowledgements (Pycboard.send_files).  The previous board side receive function
+# is kept below so both paths run against the same board.  The mean time taken and
+# data rate for each path are printed, the current path should be substantially
+# faster. Requires a pyboard with the framework installed, run from the pyControl
+# folder with:
+# python "tests/Computer tests/upload_benchmark.py" serial_port
+
+import os
+import sys
+import time
+import inspect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from com.pycboard import Pycboard, PyboardError
+
+n_repeats = 3 # Number of uploads to average over for each path.
+
+# Previous file transfer path.
+
+def _receive_file(file_path, file_size):
+    # Used on pyboard, previous per file receive function.
+    usb = pyb.USB_VCP()
+    usb.setinterrupt(-1)
+    buf_size = 512
+    buf = bytearray(buf_size)
+    buf_mv = memoryview(buf)
+    bytes_remaining = file_size
+    try:
+        with open(file_path, 'wb') as f:
+            while bytes_remaining > 0:
+                bytes_read = usb.recv(buf, timeout=5)
+                usb.write(b'OK')
+                if bytes_read:
+                    bytes_remaining -= bytes_read
+                    f.write(buf_mv[:bytes_read])
+    except:
+        if _fs_free_space() < bytes_remaining:
+            usb.write(b'NS') # Out of space.
+        else:
+            usb.write(b'ER')
+
+def previous_upload(board, files):
+    '''Upload files one at a time with the previous stop and wait protocol.'''
+    for file_path, target_path in files:
+        board.get_file_hash(target_path)
+        board.exec_raw_no_follow("_receive_file('{}',{})".format(target_path, os.path.getsize(file_path)))
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = f.read(512)
+                if not chunk:
+                    break
+                board.serial.write(chunk)
+                if board.serial.read(2) != b'OK':
+                    raise PyboardError('Transfer failed.')
+            board.follow(3)
+        board.get_file_hash(target_path)
+
+def current_upload(board, files):
+    '''Upload files with the current windowed protocol.'''
+    target_paths = repr([target_path for file_path, target_path in files])
+    board.eval('_file_hashes({})'.format(target_paths))
+    board.send_files(files)
+    board.eval('_file_hashes({})'.format(target_paths))
+
+if __name__ == '__main__':
+    board = Pycboard(sys.argv[1]) # Syncs framework so framework folders exist on board.
+    board.exec(inspect.getsource(_receive_file))
+    files = board.framework_files()
+    n_bytes = sum(os.path.getsize(file_path) for file_path, target_path in files)
+    print('Uploading {} files, {:.1f} kB'.format(len(files), n_bytes/1000))
+    for name, upload in (('previous', previous_upload), ('current', current_upload)):
+        start = time.perf_counter()
+        for i in range(n_repeats):
+            upload(board, files)
+        dur = (time.perf_counter() - start) / n_repeats
+        print('{}: {:.2f} s, {:.1f} kB/s'.format(name, dur, n_bytes/dur/1000))
+    board.close()
@@ -0,0 +1,73 @@
+# Test that a running session does not allocate memory when processing and
+# outputting events and state changes.  A timer generates an event every
+# millisecond which causes a state transition and publishes a second event.
+# After a warm up period the garbage collector is disabled and the memory
+# allocated while processing v.n_events events is measured.  The printed bytes
+# allocated per event should be 0.  Run with and without batched output and
+# microsecond timestamps to test each output path. The framework stops once the
+# test has finished.
+
+import gc
+from pyControl.utility import *
+
+# States and events.
+
+states = ['state_A',
+          'state_B']
+
+events = ['tick',
+          'tock']
+
+initial_state = 'state_A'
+
+# Variables.
+
+v.n_warmup = 100  # Number of events before measurement starts.
+v.n_events = 1000 # Number of events to measure allocation over.
+v.n_ticks = 0
+v.mem_start = 0
+
+# Run start and end behaviour.
+
+def run_start():
+    set_timer('tick', 1*ms)
+
+def run_end():
+    gc.enable()
+
+# Event handlers.
+
+def tick(state):
+    # Called on tick event in either state.
+    v.n_ticks += 1
+    if v.n_ticks == v.n_warmup:
+        gc.collect()
+        gc.disable()
+        v.mem_start = gc.mem_alloc()
+    elif v.n_ticks == v.n_warmup + v.n_events:
+        mem_used = gc.mem_alloc() - v.mem_start
+        gc.enable()
+        print('Bytes allocated per event: {:.2f}'.format(mem_used / v.n_events))
+        stop_framework()
+        return
+    publish_event('tock')
+    set_timer('tick', 1*ms)
+    goto_state(state)
+
+def tick_A():
+    tick('state_B')
+
+def tick_B():
+    tick('state_A')
+
+def no_op():
+    pass
+
+handlers = {'state_A': {'tick': tick_A, 'tock': no_op},
+            'state_B': {'tick': tick_B, 'tock': no_op}}
+
+def state_A(event):
+    pass
+
+def state_B(event):
+    pass
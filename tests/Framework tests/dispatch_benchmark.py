@@ -0,0 +1,77 @@
+# Benchmark comparing event processing by a state event handler function, which
+# compares the event name with each event in turn, against handlers bound to events
+# in the handlers dict, which are looked up by event ID.  For each method the mean
+# time to process the first and the last event in the handler is printed in
+# microseconds.  The bound handler times should be similar for both events and
+# lower than the state event handler function times. The framework stops once
+# the benchmark has finished.
+
+import pyb
+import pyControl.framework as fw
+from pyControl.utility import *
+
+# States and events.
+
+states = ['function_state',
+          'table_state']
+
+events = ['start_benchmark'] + ['event_{}'.format(i) for i in range(10)]
+
+initial_state = 'function_state'
+
+# Variables.
+
+v.n_calls = 1000 # Number of calls to average over for each measurement.
+
+# Benchmark.
+
+def time_events(event):
+    # Return mean time in us to process event in current state.
+    event_ID = fw.events[event]
+    start = pyb.micros()
+    for i in range(v.n_calls):
+        fw.state_machine._process_event_ID(event_ID)
+    return pyb.elapsed_micros(start) / v.n_calls
+
+def run_benchmark():
+    print('handler, first event (us), last event (us)')
+    for state in states:
+        goto_state(state)
+        print('{}, {:.1f}, {:.1f}'.format(state, time_events('event_0'), time_events('event_9')))
+    stop_framework()
+
+def run_start():
+    set_timer('start_benchmark', 10*ms)
+
+# State event handler function.
+
+def function_state(event):
+    if event == 'start_benchmark':
+        run_benchmark()
+    elif event == 'event_0':
+        pass
+    elif event == 'event_1':
+        pass
+    elif event == 'event_2':
+        pass
+    elif event == 'event_3':
+        pass
+    elif event == 'event_4':
+        pass
+    elif event == 'event_5':
+        pass
+    elif event == 'event_6':
+        pass
+    elif event == 'event_7':
+        pass
+    elif event == 'event_8':
+        pass
+    elif event == 'event_9':
+        pass
+
+# Bound handlers.
+
+def no_op():
+    pass
+
+handlers = {'table_state': {'event_{}'.format(i): no_op for i in range(10)}}
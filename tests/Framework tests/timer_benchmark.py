@@ -0,0 +1,52 @@
+# Benchmark for the framework timer.  For each number of outstanding timers
+# the task sets that many timers with long intervals, then measures the mean
+# time taken to set a timer, to get the time remaining, and to disarm a timer.
+# Results are printed in microseconds per call, the times should increase only
+# slowly with the number of outstanding timers. The framework stops once the
+# benchmark has finished.
+
+import pyb
+from pyControl.utility import *
+
+# States and events.
+
+states = ['benchmark']
+
+events = ['timer_{}'.format(i) for i in range(500)]
+
+initial_state = 'benchmark'
+
+# Variables.
+
+v.n_timers = [10, 50, 100, 200, 500] # Numbers of outstanding timers to test.
+v.n_calls = 100 # Number of calls to average over for each measurement.
+
+# Benchmark.
+
+def time_calls(func, n_outstanding):
+    # Return mean time in us of func(event) over n_calls events.
+    start = pyb.micros()
+    for i in range(v.n_calls):
+        func('timer_{}'.format(i % n_outstanding))
+    return pyb.elapsed_micros(start) / v.n_calls
+
+def overhead(n_outstanding):
+    # Time taken by loop and string formatting in time_calls.
+    return time_calls(lambda event: None, n_outstanding)
+
+def run_start():
+    print('n_timers, set (us), remaining (us), disarm (us)')
+    for n in v.n_timers:
+        for i in range(n):
+            set_timer('timer_{}'.format(i), 60*minute + i, output_event=True)
+        t_0 = overhead(n)
+        t_set = time_calls(lambda event: set_timer(event, 60*minute), n) - t_0
+        t_rem = time_calls(timer_remaining, n) - t_0
+        t_dis = time_calls(disarm_timer, n) - t_0
+        print('{}, {:.1f}, {:.1f}, {:.1f}'.format(n, t_set, t_rem, t_dis))
+        for i in range(n):
+            disarm_timer('timer_{}'.format(i))
+    stop_framework()
+
+def benchmark(event):
+    pass
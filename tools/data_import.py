@@ -32,10 +32,15 @@ class Session():
       - times
           A dictionary with keys that are the names of the framework events and states and 
           corresponding values which are Numpy arrays of all the times (in milliseconds since the
-           start of the framework run) at which each event/state entry occured.
+           start of the framework run) at which each event/state entry occured.  Events recorded
+           with microsecond timestamps have times with three decimal places.
       - print_lines
           A list of all the lines output by print statements during the framework run, each line starts 
           with the time in milliseconds at which it was printed.
+      - frame_checkpoints
+          A dictionary with keys that are the names of camera frame events and values which are tuples
+          (frame_numbers, times) of Numpy arrays of the frame checkpoints, which can be converted into
+          the times of all frames using tools/frame_times.py.
     '''
 
     def __init__(self, file_path, int_subject_IDs=True):
@@ -76,16 +81,29 @@ class Session():
 
         data_lines = [line[2:].split(' ') for line in all_lines if line[0]=='D']
 
-        self.events = [Event(int(dl[0]), ID2name[int(dl[1])]) for dl in data_lines]
+        self.events = [Event(_parse_time(dl[0]), ID2name[int(dl[1])]) for dl in data_lines]
 
         self.times = {event_name: np.array([ev.time for ev in self.events if ev.name == event_name])  
                       for event_name in ID2name.values()}
 
         self.print_lines = [line[2:] for line in all_lines if line[0]=='P']
+
+        frame_lines = [line[2:].split(' ') for line in all_lines if line[0]=='F']
+
+        self.frame_checkpoints = {}
+        for event_name in set(ID2name[int(fl[1])] for fl in frame_lines):
+            event_lines = [fl for fl in frame_lines if ID2name[int(fl[1])] == event_name]
+            self.frame_checkpoints[event_name] = (np.array([int(fl[2]) for fl in event_lines]),
+                                                  np.array([int(fl[0]) for fl in event_lines]))
         
         self.state_IDs = state_IDs
         self.event_IDs = event_IDs
 
+def _parse_time(time_string):
+    '''Convert time string from data file to int, or to float for times with
+    microsecond resolution.'''
+    return float(time_string) if '.' in time_string else int(time_string)
+
 #----------------------------------------------------------------------------------
 # Experiment class
 #----------------------------------------------------------------------------------
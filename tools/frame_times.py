@@ -0,0 +1,54 @@
+# Function for reconstructing the times of all camera frames from the frame
+# checkpoints output by the pyControl Camera device, which record the frame number
+# and time of every checkpoint_interval'th frame.  Frame times between checkpoints
+# are linearly interpolated.
+# Dependencies: Python 3, Numpy.
+
+import numpy as np
+
+def frame_times(frame_numbers, checkpoint_times, n_frames=None, frame_rate=None):
+    '''Return a Numpy array of the time of every frame, indexed by frame number, 
+    reconstructed from frame checkpoints.  Each time the frame trigger is started 
+    a checkpoint is output for its first frame, so the checkpoints form one segment
+    per period of triggering.  Frame times within a segment are interpolated between
+    checkpoints, frames after the last checkpoint of a segment are extrapolated using
+    the frame period.
+
+    Arguments:
+
+    frame_numbers: Frame numbers of the checkpoints, e.g. session.frame_checkpoints
+                   [frame_event][0] for a session imported with data_import.Session.
+
+    checkpoint_times: Times of the checkpoints (ms).
+
+    n_frames: Total number of frames, e.g. from the video file, if not specified the
+              last checkpoint is taken to be the last frame.
+
+    frame_rate: Frame rate (Hz), if not specified the frame period is estimated from
+                the checkpoints.
+    '''
+    frame_numbers = np.asarray(frame_numbers)
+    checkpoint_times = np.asarray(checkpoint_times, float)
+    if n_frames is None:
+        n_frames = frame_numbers[-1] + 1
+    frame_periods = np.diff(checkpoint_times)/np.diff(frame_numbers)
+    if frame_rate:
+        period = 1000/frame_rate
+    elif len(frame_periods):
+        period = np.median(frame_periods)
+    else:
+        raise ValueError('frame_rate must be specified if there is only one checkpoint.')
+    # Checkpoints where triggering restarted are followed by a gap in time.
+    seg_starts = np.hstack([0, np.where(frame_periods > 1.5*period)[0] + 1])
+    seg_ends = np.hstack([seg_starts[1:], len(frame_numbers)])
+    times = np.zeros(n_frames)
+    for s, e in zip(seg_starts, seg_ends):
+        seg_frames = frame_numbers[s:e]
+        seg_times = checkpoint_times[s:e]
+        last_frame = frame_numbers[e] - 1 if e < len(frame_numbers) else n_frames - 1
+        frames = np.arange(seg_frames[0], last_frame + 1)
+        seg_frame_times = np.interp(frames, seg_frames, seg_times)
+        after = frames > seg_frames[-1]
+        seg_frame_times[after] = seg_times[-1] + (frames[after] - seg_frames[-1])*period
+        times[frames] = seg_frame_times
+    return times
@@ -40,10 +40,10 @@ def session_plot(file_path, fig_no=1, return_fig=False):
 
     data_lines = [line[2:].split(' ') for line in all_lines if line[0]=='D']
 
-    event_times = np.array([int(dl[0]) for dl in data_lines if int(dl[1]) in events_dict.values()])/1000 
+    event_times = np.array([float(dl[0]) for dl in data_lines if int(dl[1]) in events_dict.values()])/1000 
     event_IDs   = np.array([int(dl[1]) for dl in data_lines if int(dl[1]) in events_dict.values()]) 
 
-    state_times = np.array([int(dl[0]) for dl in data_lines if int(dl[1]) in states_dict.values()])/1000 
+    state_times = np.array([float(dl[0]) for dl in data_lines if int(dl[1]) in states_dict.values()])/1000 
     state_IDs   = np.array([int(dl[1]) for dl in data_lines if int(dl[1]) in states_dict.values()]) 
 
     state_durations = np.diff(state_times)